@@ -1,7 +1,14 @@
 from flask import Flask
-from routes import app1
+from routes import app1, get_job_manager
+import logging
 
 def create_app():
     app = Flask(__name__)
     app.register_blueprint(app1)
+
+    # Продолжаем фоновые загрузки, прерванные перезапуском контейнера
+    try:
+        get_job_manager()
+    except Exception as e:
+        logging.error(f"Background jobs are unavailable: {str(e)}")
     return app
\ No newline at end of file
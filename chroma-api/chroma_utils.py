@@ -1,11 +1,705 @@
 from chromadb import HttpClient
 from chromadb.config import Settings
-from typing import List, Dict, Any, Optional
-from openai import OpenAI
-import uuid
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+from openai import OpenAI, DefaultHttpxClient, RateLimitError, APIConnectionError, InternalServerError
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache
+from array import array
+import importlib.util
+import httpx
+from pipeline import IngestionPipeline
+from lexical import LexicalIndex
+from rerankers import get_reranker, mmr_select
+import tiktoken
+import base64
+import hashlib
+import itertools
+import json
+import tempfile
 import logging
 import os
+import random
 import threading
+import time
+
+try:
+    import redis
+except ImportError:  # Redis - необязательный общий уровень кэша
+    redis = None
+
+
+def _env_int(name: str, default: int) -> int:
+    """Читает целочисленную настройку из окружения (пустое значение = default)"""
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+# Лимиты одного запроса к OpenAI Embeddings API
+# (API принимает до 2048 входов и до 300k токенов суммарно на запрос)
+EMBEDDING_BATCH_SIZE = min(_env_int('CHROMA_EMBEDDING_BATCH_SIZE', 512), 2048)
+EMBEDDING_BATCH_TOKENS = _env_int('CHROMA_EMBEDDING_BATCH_TOKENS', 250000)
+
+# Сколько батчей эмбеддингов отправляется параллельно и сколько раз повторять
+# запрос при 429 / сетевых ошибках
+EMBEDDING_CONCURRENCY = max(1, _env_int('CHROMA_EMBEDDING_CONCURRENCY', 4))
+EMBEDDING_MAX_RETRIES = _env_int('CHROMA_EMBEDDING_MAX_RETRIES', 6)
+
+# Пул клиентов OpenAI по API ключу: максимум клиентов, время простоя до закрытия (сек)
+# и число keep-alive соединений на клиента. HTTP/2 - если установлен пакет h2
+OPENAI_POOL_SIZE = max(1, _env_int('CHROMA_OPENAI_POOL_SIZE', 8))
+OPENAI_POOL_IDLE_SECONDS = _env_int('CHROMA_OPENAI_POOL_IDLE_SECONDS', 600)
+OPENAI_KEEPALIVE_CONNECTIONS = _env_int('CHROMA_OPENAI_KEEPALIVE_CONNECTIONS', 16)
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Кэш эмбеддингов: лимит памяти на воркер (0 - отключен) и каталог дискового уровня
+# (пусто - без диска; в docker-compose примонтирован /data/shared)
+EMBEDDING_CACHE_MB = _env_int('CHROMA_EMBEDDING_CACHE_MB', 256)
+EMBEDDING_CACHE_DIR = os.getenv('CHROMA_EMBEDDING_CACHE_DIR', '')
+
+# Общий кэш в Redis для всех воркеров (пусто - только локальные кэши)
+REDIS_URL = os.getenv('CHROMA_REDIS_URL', '')
+EMBEDDING_CACHE_TTL = _env_int('CHROMA_EMBEDDING_CACHE_TTL', 7 * 24 * 3600)
+
+# Запись в Chroma батчами: максимум записей и размер тела запроса в MB.
+# При CHROMA_WRITE_PIPELINE=1 чтение, эмбеддинги и запись идут параллельно
+# (потоковый конвейер с батчами по CHROMA_PIPELINE_BATCH_SIZE чанков)
+WRITE_BATCH_SIZE = _env_int('CHROMA_WRITE_BATCH_SIZE', 1000)
+WRITE_BATCH_BYTES = _env_int('CHROMA_WRITE_BATCH_MB', 32) * 1024 * 1024
+WRITE_PIPELINE = os.getenv('CHROMA_WRITE_PIPELINE', '1') not in ('0', 'false', 'False', '')
+PIPELINE_BATCH_SIZE = _env_int('CHROMA_PIPELINE_BATCH_SIZE', 256)
+PIPELINE_QUEUE_SIZE = _env_int('CHROMA_PIPELINE_QUEUE_SIZE', 2)
+# Оценка размера одного float эмбеддинга в JSON теле запроса к Chroma
+EMBEDDING_FLOAT_JSON_BYTES = 20
+
+# Кэш результатов поиска: записей на воркер и время жизни в секундах (0 - отключен).
+# Без CHROMA_REDIS_URL кэш работает только при одном воркере gunicorn
+# (CHROMA_API_WORKERS - число воркеров, как в Dockerfile)
+QUERY_CACHE_SIZE = _env_int('CHROMA_QUERY_CACHE_SIZE', 1000)
+QUERY_CACHE_TTL = _env_int('CHROMA_QUERY_CACHE_TTL', 300)
+API_WORKERS = _env_int('CHROMA_API_WORKERS', 4)
+
+# Кэш эмбеддингов поисковых запросов: записей на воркер, время жизни в секундах
+# (0 - отключен) и нормализация текста запроса для ключа кэша: whitespace - схлопывание
+# пробелов, case - без учета регистра (пусто - без нормализации). В OpenAI уходит
+# исходный текст запроса
+QUERY_EMBEDDING_CACHE_SIZE = _env_int('CHROMA_QUERY_EMBEDDING_CACHE_SIZE', 5000)
+QUERY_EMBEDDING_CACHE_TTL = _env_int('CHROMA_QUERY_EMBEDDING_CACHE_TTL', 3600)
+QUERY_NORMALIZE = {
+    option.strip() for option in
+    os.getenv('CHROMA_QUERY_NORMALIZE', 'whitespace').split(',') if option.strip()
+}
+
+# Максимум запросов в одном вызове query_batch
+QUERY_BATCH_MAX = _env_int('CHROMA_QUERY_BATCH_MAX', 100)
+# BM25 индекс для гибридного поиска: каталог с файлами SQLite FTS5 по коллекциям
+# (пусто - отключен), число кандидатов с каждой стороны и константа k для RRF
+LEXICAL_INDEX_DIR = os.getenv('CHROMA_LEXICAL_INDEX_DIR', '')
+HYBRID_CANDIDATES = _env_int('CHROMA_HYBRID_CANDIDATES', 50)
+RRF_K = _env_int('CHROMA_RRF_K', 60)
+
+# Переранжирование: во сколько раз больше кандидатов запрашивать (k x m)
+RERANK_CANDIDATES_FACTOR = max(1, _env_int('CHROMA_RERANK_CANDIDATES_FACTOR', 4))
+
+# Удаление по фильтру: сколько ID выбирается и удаляется за один запрос к Chroma
+DELETE_BATCH_SIZE = max(1, _env_int('CHROMA_DELETE_BATCH_SIZE', 1000))
+
+# show_collection: записей на страницу при постраничном чтении из Chroma
+# и максимум записей в одном (не потоковом) ответе
+SHOW_COLLECTION_PAGE_SIZE = max(1, _env_int('CHROMA_SHOW_COLLECTION_PAGE_SIZE', 1000))
+SHOW_COLLECTION_MAX_LIMIT = max(1, _env_int('CHROMA_SHOW_COLLECTION_MAX_LIMIT', 10000))
+# Поля, которые можно запросить в include (ID возвращаются всегда)
+DOCUMENT_FIELDS = ('documents', 'metadatas', 'embeddings')
+
+# Сколько коллекций опрашивается параллельно при федеративном поиске
+FEDERATED_QUERY_WORKERS = max(1, _env_int('CHROMA_FEDERATED_QUERY_WORKERS', 8))
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """
+    Токенайзер tiktoken для модели (cl100k_base для неизвестных моделей).
+    Возвращает None, если словарь токенайзера недоступен (например, нет сети)
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logging.warning(f"tiktoken encoding unavailable for {model}, "
+                        f"falling back to byte-length estimate: {str(e)}")
+        return None
+
+
+def _normalize_query(text: str) -> str:
+    """Нормализует текст поискового запроса согласно CHROMA_QUERY_NORMALIZE"""
+    if 'whitespace' in QUERY_NORMALIZE:
+        text = ' '.join(text.split())
+    if 'case' in QUERY_NORMALIZE:
+        text = text.casefold()
+    return text
+
+
+def _count_tokens(text: str, model: str) -> int:
+    """Число токенов в тексте (без tiktoken - оценка сверху по длине в байтах)"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text.encode('utf-8'))
+    return len(encoding.encode_ordinary(text))
+
+
+class _AdaptiveLimiter:
+    """
+    Адаптивный ограничитель параллельных запросов (AIMD):
+    при 429 лимит уменьшается вдвое, после серии успешных запросов растет на 1
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, throttled: bool = False):
+        with self._cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self.limit < self.max_limit and self._successes >= self.limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+def _retry_delay(attempt: int, response=None) -> float:
+    """Пауза перед повтором: Retry-After из ответа или экспонента с jitter"""
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = min(60.0, 2.0 ** attempt)
+    return delay + random.uniform(0, 1)
+
+
+class OpenAIClientPool:
+    """
+    Потокобезопасный пул клиентов OpenAI с ключом по API ключу.
+    Клиент держит keep-alive соединения (HTTP/2, если доступен), поэтому
+    повторные запросы не платят за TCP/TLS рукопожатие. Пул ограничен по размеру,
+    клиенты, простаивающие дольше idle_seconds, удаляются
+    """
+
+    def __init__(self, max_size: int, idle_seconds: int):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        # sha256(api_key) -> [client, время последнего использования]
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create(api_key: str) -> OpenAI:
+        http_client = DefaultHttpxClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=max(OPENAI_KEEPALIVE_CONNECTIONS, EMBEDDING_CONCURRENCY),
+                max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_POOL_IDLE_SECONDS
+            )
+        )
+        # Повторы выполняет _embed_batch, чтобы видеть каждый 429
+        return OpenAI(api_key=api_key, max_retries=0, http_client=http_client)
+
+    def get(self, api_key: str) -> OpenAI:
+        key = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            # Вытесненные клиенты не закрываем явно: ими могут пользоваться
+            # другие потоки, соединения закроются при сборке мусора
+            while self._clients:
+                oldest_key, (_, last_used) = next(iter(self._clients.items()))
+                if now - last_used <= self.idle_seconds:
+                    break
+                del self._clients[oldest_key]
+
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(key)
+                return entry[0]
+
+            client = self._create(api_key)
+            self._clients[key] = [client, now]
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+            return client
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "http2": HTTP2_AVAILABLE
+            }
+
+
+class RedisCache:
+    """
+    Общий для всех gunicorn воркеров кэш в Redis (service_redis).
+    Ключи разделены на namespace; namespace инвалидируется увеличением счетчика
+    поколения, который входит в ключи. Если Redis не настроен или недоступен,
+    методы возвращают None и сервис работает только с локальными кэшами
+    """
+    PREFIX = 'chroma_api'
+    # Пауза перед повторной попыткой обращения к недоступному Redis
+    RETRY_INTERVAL = 30
+
+    def __init__(self, url: Optional[str]):
+        self._client = None
+        self._down_until = 0.0
+        if url and redis is not None:
+            self._client = redis.Redis.from_url(url, socket_timeout=0.5,
+                                                socket_connect_timeout=0.5)
+        elif url:
+            logging.warning("CHROMA_REDIS_URL is set but redis package is not installed")
+
+    @property
+    def configured(self) -> bool:
+        return self._client is not None
+
+    @property
+    def available(self) -> bool:
+        return self._client is not None and time.monotonic() >= self._down_until
+
+    def _call(self, method: str, *args, **kwargs):
+        if not self.available:
+            return None
+        try:
+            return getattr(self._client, method)(*args, **kwargs)
+        except redis.RedisError as e:
+            logging.warning(f"Redis unavailable, using local cache only: {str(e)}")
+            self._down_until = time.monotonic() + self.RETRY_INTERVAL
+            return None
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.PREFIX}:{namespace}:{key}"
+
+    def namespace_version(self, namespace: str) -> Optional[int]:
+        """Текущее поколение namespace (None - Redis недоступен)"""
+        value = self._call('get', self._key('ns', namespace))
+        if value is None:
+            return 0 if self.available else None
+        return int(value)
+
+    def bump_namespace(self, namespace: str) -> bool:
+        """
+        Инвалидирует все ключи namespace, записанные с учетом поколения.
+        Инвалидация не пропускается из-за паузы после прошлой ошибки: Redis
+        опрашивается всегда. False - поколение не увеличено
+        """
+        if self._client is None:
+            return False
+        try:
+            self._client.incr(self._key('ns', namespace))
+            return True
+        except redis.RedisError as e:
+            logging.warning(f"Redis namespace invalidation failed: {str(e)}")
+            self._down_until = time.monotonic() + self.RETRY_INTERVAL
+            return False
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        return self._call('get', self._key(namespace, key))
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: int):
+        self._call('set', self._key(namespace, key), value, ex=ttl or None)
+
+    def get_many(self, namespace: str, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        values = self._call('mget', [self._key(namespace, key) for key in keys])
+        return values if values is not None else [None] * len(keys)
+
+    def set_many(self, namespace: str, items: Dict[str, bytes], ttl: int):
+        if not items or not self.available:
+            return
+        try:
+            pipe = self._client.pipeline(transaction=False)
+            for key, value in items.items():
+                pipe.set(self._key(namespace, key), value, ex=ttl or None)
+            pipe.execute()
+        except redis.RedisError as e:
+            logging.warning(f"Redis unavailable, using local cache only: {str(e)}")
+            self._down_until = time.monotonic() + self.RETRY_INTERVAL
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "configured": self._client is not None,
+            "available": self.available
+        }
+
+
+class EmbeddingCache:
+    """
+    Кэш эмбеддингов с ключом (model_name, sha256(text)).
+    Уровни: LRU в памяти процесса с ограничением по байтам, опциональный Redis,
+    общий для воркеров, и опциональный каталог на диске.
+    Векторы хранятся как упакованные float32
+    """
+    # Примерные накладные расходы Python на одну запись LRU
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes: int, cache_dir: Optional[str] = None,
+                 shared: Optional[RedisCache] = None, shared_ttl: int = 0):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir or None
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def pack(embedding: List[float]) -> bytes:
+        return array('f', embedding).tobytes()
+
+    @staticmethod
+    def unpack(data: bytes) -> List[float]:
+        vector = array('f')
+        vector.frombytes(data)
+        return vector.tolist()
+
+    def _disk_path(self, model: str, digest: str) -> str:
+        safe_model = model.replace('/', '_')
+        return os.path.join(self.cache_dir, safe_model, digest[:2], f"{digest}.f32")
+
+    def _remember(self, key: tuple, data: bytes):
+        """Кладет запись в LRU и вытесняет старые записи сверх лимита памяти"""
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = data
+            self._size += len(data) + self.ENTRY_OVERHEAD
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted) + self.ENTRY_OVERHEAD
+
+    def _read_disk(self, model: str, digest: str) -> Optional[bytes]:
+        try:
+            with open(self._disk_path(model, digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning(f"Embedding cache disk read failed: {str(e)}")
+            return None
+
+    def _write_disk(self, model: str, digest: str, data: bytes):
+        path = self._disk_path(model, digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Пишем во временный файл и атомарно переименовываем,
+            # чтобы другие воркеры не прочитали недописанный вектор
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+        except OSError as e:
+            logging.warning(f"Embedding cache disk write failed: {str(e)}")
+
+    def get_many(self, model: str, digests: List[str]) -> Dict[str, List[float]]:
+        """Возвращает найденные векторы {digest: embedding}, обходя уровни по очереди"""
+        found = {}
+        missing = []
+        with self._lock:
+            for digest in digests:
+                data = self._entries.get((model, digest))
+                if data is None:
+                    missing.append(digest)
+                else:
+                    self._entries.move_to_end((model, digest))
+                    found[digest] = data
+            self.hits += len(found)
+
+        if missing and self.shared is not None:
+            values = self.shared.get_many(f"emb:{model}", missing)
+            shared_found = {d: v for d, v in zip(missing, values) if v is not None}
+            found.update(shared_found)
+            missing = [d for d in missing if d not in shared_found]
+            with self._lock:
+                self.shared_hits += len(shared_found)
+            for digest, data in shared_found.items():
+                self._remember((model, digest), data)
+
+        if missing and self.cache_dir:
+            disk_found = {}
+            for digest in missing:
+                data = self._read_disk(model, digest)
+                if data is not None:
+                    disk_found[digest] = data
+                    self._remember((model, digest), data)
+            found.update(disk_found)
+            missing = [d for d in missing if d not in disk_found]
+            with self._lock:
+                self.disk_hits += len(disk_found)
+            # Поднимаем найденное на диске в общий уровень для других воркеров
+            if self.shared is not None:
+                self.shared.set_many(f"emb:{model}", disk_found, self.shared_ttl)
+
+        with self._lock:
+            self.misses += len(missing)
+        return {digest: self.unpack(data) for digest, data in found.items()}
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        packed = {digest: self.pack(embedding) for digest, embedding in items.items()}
+        for digest, data in packed.items():
+            self._remember((model, digest), data)
+            if self.cache_dir:
+                self._write_disk(model, digest, data)
+        if self.shared is not None:
+            self.shared.set_many(f"emb:{model}", packed, self.shared_ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory_bytes": self._size,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses
+            }
+
+
+class QueryResultCache:
+    """
+    Кэш результатов query_collection с ключом
+    (коллекция, хэш эмбеддинга запроса, n_results, where, where_document).
+    Локальный LRU с TTL плюс опциональный Redis. Каждая коллекция - отдельный
+    namespace: add/delete документов и delete_collection меняют его поколение,
+    поэтому устаревшие результаты не отдаются. Поколения хранятся в Redis,
+    общем для воркеров; без Redis - в процессе, и тогда кэш включен только
+    при одном воркере. Пока Redis недоступен или поколение коллекции не удалось
+    увеличить, результаты этой коллекции не отдаются из кэша и не сохраняются
+    """
+
+    def __init__(self, max_entries: int, ttl: int, shared: Optional[RedisCache] = None,
+                 workers: int = 1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared if shared is not None and shared.configured else None
+        self.workers = workers
+        self._entries = OrderedDict()
+        self._versions = {}
+        # Коллекции, изменение которых не удалось отметить в Redis
+        self._pending = set()
+        self._retry_timer = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        # Без общего хранилища поколений запись в одном воркере
+        # не сбросит результаты, закэшированные остальными
+        return (self.max_entries > 0 and self.ttl > 0
+                and (self.shared is not None or self.workers <= 1))
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def version(self, collection_name: str) -> Optional[tuple]:
+        """
+        Поколение коллекции: из Redis, если он настроен, иначе локальное.
+        Берется до выполнения запроса, чтобы результат, посчитанный во время
+        изменения коллекции, не попал в кэш под новым поколением.
+        None - результаты коллекции сейчас не кэшируются
+        """
+        if not self.enabled:
+            return None
+        if self.shared is None:
+            with self._lock:
+                return ('local', self._versions.get(collection_name, 0))
+
+        self._retry_pending()
+        with self._lock:
+            if collection_name in self._pending:
+                return None
+        version = self.shared.namespace_version(f"col:{collection_name}")
+        if version is None:
+            return None
+        return ('shared', version)
+
+    def _retry_pending(self, force: bool = False):
+        """Повторяет неудавшиеся инвалидации, как только Redis снова доступен"""
+        with self._lock:
+            pending = list(self._pending)
+        for collection_name in pending:
+            if not (force or self.shared.available):
+                return
+            if not self.shared.bump_namespace(f"col:{collection_name}"):
+                return
+            with self._lock:
+                self._pending.discard(collection_name)
+
+    def _schedule_retry(self):
+        """
+        Повторяет инвалидации в фоне: остальные воркеры видят прежнее поколение,
+        пока этот воркер не увеличит его, даже если сам он больше не получает запросов
+        """
+        with self._lock:
+            if self._retry_timer is not None or not self._pending:
+                return
+            self._retry_timer = threading.Timer(self.shared.RETRY_INTERVAL, self._retry_in_background)
+            self._retry_timer.daemon = True
+            self._retry_timer.start()
+
+    def _retry_in_background(self):
+        with self._lock:
+            self._retry_timer = None
+        self._retry_pending(force=True)
+        self._schedule_retry()
+
+    def get(self, collection_name: str, version: Optional[tuple],
+            key: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled or version is None:
+            return None
+        local_key = (collection_name, version, key)
+
+        with self._lock:
+            entry = self._entries.get(local_key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(local_key)
+                self.hits += 1
+                return json.loads(entry[1])
+
+        data = None
+        if self.shared is not None and version[0] == 'shared':
+            data = self.shared.get(f"col:{collection_name}:{version[1]}", key)
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._store_local(local_key, data)
+        return json.loads(data)
+
+    def put(self, collection_name: str, version: Optional[tuple], key: str,
+            result: Dict[str, Any]):
+        if not self.enabled or version is None:
+            return
+        with self._lock:
+            if collection_name in self._pending:
+                return
+        data = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self._store_local((collection_name, version, key), data)
+        if self.shared is not None and version[0] == 'shared':
+            self.shared.set(f"col:{collection_name}:{version[1]}", key, data, self.ttl)
+
+    def _store_local(self, local_key: tuple, data: bytes):
+        with self._lock:
+            self._entries[local_key] = (time.monotonic() + self.ttl, data)
+            self._entries.move_to_end(local_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection_name: str):
+        """Сбрасывает все закэшированные результаты коллекции"""
+        with self._lock:
+            self._versions[collection_name] = self._versions.get(collection_name, 0) + 1
+            for local_key in [k for k in self._entries if k[0] == collection_name]:
+                del self._entries[local_key]
+        if self.shared is not None and not self.shared.bump_namespace(f"col:{collection_name}"):
+            # Другие воркеры видят прежнее поколение; этот воркер не кэширует
+            # коллекцию, пока поколение не будет увеличено
+            with self._lock:
+                self._pending.add(collection_name)
+            logging.warning(f"Query cache of {collection_name} is not invalidated in Redis, "
+                            f"will retry")
+            self._schedule_retry()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "pending_invalidations": len(self._pending)
+            }
+
+
+class QueryEmbeddingCache:
+    """
+    Кэш эмбеддингов поисковых запросов с ключом (model_name, нормализованный текст).
+    LRU с TTL в памяти процесса: повторные и почти одинаковые вопросы
+    (отличающиеся пробелами или регистром) не ходят в OpenAI
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl > 0
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        if not self.enabled:
+            return None
+        key = (model, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return EmbeddingCache.unpack(entry[1])
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        if not self.enabled:
+            return
+        key = (model, text)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, EmbeddingCache.pack(embedding))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
 
 class ChromaManager:
     """
@@ -41,122 +735,396 @@ class ChromaManager:
             settings=Settings(anonymized_telemetry=False)
         )
 
+        # Общий для всех запросов воркера лимит параллельных вызовов OpenAI
+        self._embedding_limiter = _AdaptiveLimiter(EMBEDDING_CONCURRENCY)
+        self.openai_clients = OpenAIClientPool(OPENAI_POOL_SIZE, OPENAI_POOL_IDLE_SECONDS)
+        # Лимит записей в батче на сервере Chroma (запрашивается при первой записи)
+        self._server_batch_limit = None
+        self.shared_cache = RedisCache(REDIS_URL)
+        self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MB * 1024 * 1024,
+                                              EMBEDDING_CACHE_DIR,
+                                              shared=self.shared_cache,
+                                              shared_ttl=EMBEDDING_CACHE_TTL)
+        self.query_cache = QueryResultCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL,
+                                            shared=self.shared_cache, workers=API_WORKERS)
+        self.query_embedding_cache = QueryEmbeddingCache(QUERY_EMBEDDING_CACHE_SIZE,
+                                                         QUERY_EMBEDDING_CACHE_TTL)
+        self.lexical_index = None
+        if LEXICAL_INDEX_DIR:
+            try:
+                self.lexical_index = LexicalIndex(LEXICAL_INDEX_DIR)
+            except Exception as e:
+                logging.warning(f"Lexical index disabled: {str(e)}")
+
         self._initialized = True
         logging.info(f"ChromaDB client initialized: {host}:{port}")
 
+    def _embedding_batches(self, texts: List[str], model: str) -> List[tuple]:
+        """
+        Разбивает тексты на последовательные батчи (start, end) с учетом
+        лимитов на количество входов и суммарное число токенов в запросе
+        """
+        batches = []
+        start = 0
+        batch_tokens = 0
+
+        for i, text in enumerate(texts):
+            tokens = _count_tokens(text, model)
+            batch_full = (i - start >= EMBEDDING_BATCH_SIZE or
+                          batch_tokens + tokens > EMBEDDING_BATCH_TOKENS)
+            if i > start and batch_full:
+                batches.append((start, i))
+                start = i
+                batch_tokens = 0
+            batch_tokens += tokens
+
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    def _embed_batch(self, client: OpenAI, texts: List[str], model: str) -> List[List[float]]:
+        """
+        Отправляет один батч в OpenAI с повторами.
+        При 429 уменьшает параллельность и ждет Retry-After / экспоненциальную паузу
+        """
+        for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+            self._embedding_limiter.acquire()
+            throttled = False
+            try:
+                response = client.embeddings.create(
+                    input=texts,
+                    model=model
+                )
+                # API возвращает index для каждого входа - восстанавливаем порядок
+                batch = sorted(response.data, key=lambda item: item.index)
+                return [item.embedding for item in batch]
+            except RateLimitError as e:
+                # Исчерпанную квоту повторять бессмысленно
+                if e.code == 'insufficient_quota' or attempt == EMBEDDING_MAX_RETRIES:
+                    raise
+                throttled = True
+                delay = _retry_delay(attempt, e.response)
+            except (APIConnectionError, InternalServerError):
+                if attempt == EMBEDDING_MAX_RETRIES:
+                    raise
+                delay = _retry_delay(attempt)
+            finally:
+                self._embedding_limiter.release(throttled)
+
+            logging.warning(f"Embedding batch failed (attempt {attempt + 1}), "
+                            f"retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def _request_embeddings(self, texts: List[str], api_key: Optional[str],
+                            model: str) -> List[List[float]]:
+        """
+        Запрашивает эмбеддинги у OpenAI батчами параллельно
+        (до CHROMA_EMBEDDING_CONCURRENCY), порядок совпадает с порядком texts
+        """
+        # Используем переданный api_key или берем из переменных окружения
+        api_key = api_key or os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY not found in environment variables")
+
+        client = self.openai_clients.get(api_key)
+
+        batches = self._embedding_batches(texts, model)
+
+        def embed(batch):
+            start, end = batch
+            return self._embed_batch(client, texts[start:end], model)
+
+        if len(batches) <= 1:
+            results = map(embed, batches)
+        else:
+            workers = min(EMBEDDING_CONCURRENCY, len(batches))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(embed, batches))
+
+        embeddings = []
+        for result in results:
+            embeddings.extend(result)
+        return embeddings
+
     def _create_embeddings(self, texts: List[str], api_key: Optional[str] = None,
                              model_name: Optional[str] = None) -> List[List[float]]:
         """
-        Создает эмбеддинги для списка текстов с использованием OpenAI API
+        Создает эмбеддинги для списка текстов с использованием OpenAI API.
+        Уже известные тексты берутся из кэша, одинаковые тексты эмбеддятся один раз
         """
         # Определяем модель сразу, чтобы она была доступна в exception handler
         model = model_name or os.getenv('CHROMA_MODEL', 'text-embedding-3-large')
 
         try:
-            # Используем переданный api_key или берем из переменных окружения
-            api_key = api_key or os.getenv('OPENAI_API_KEY')
-            if not api_key:
-                raise ValueError("OPENAI_API_KEY not found in environment variables")
+            digests = [EmbeddingCache.digest(text) for text in texts]
+            unique = list(dict.fromkeys(digests))
+            found = self.embedding_cache.get_many(model, unique)
 
-            client = OpenAI(api_key=api_key)
+            missing = {}
+            for digest, text in zip(digests, texts):
+                if digest not in found:
+                    missing[digest] = text
 
-            embeddings = []
-            for text in texts:
-                response = client.embeddings.create(
-                    input=text,
-                    model=model
-                )
-                embeddings.append(response.data[0].embedding)
-            return embeddings
+            if missing:
+                new_embeddings = self._request_embeddings(list(missing.values()), api_key, model)
+                new_items = dict(zip(missing, new_embeddings))
+                self.embedding_cache.put_many(model, new_items)
+                found.update(new_items)
+
+            logging.info(f"Embeddings: {len(texts)} texts, "
+                         f"{len(missing)} requested from OpenAI")
+            return [found[digest] for digest in digests]
         except Exception as e:
             logging.error(f"Error creating embeddings: {str(e)}")
             logging.error(f"Model used: {model}")
             raise
 
-    def add_documents(self, collection_name: str, texts: List[str],
-                      metadata: Optional[List[Dict[str, Any]]] = None,
-                      api_key: Optional[str] = None,
-                      model_name: Optional[str] = None,
-                      **kwargs) -> Dict[str, Any]:
+    def _max_write_batch(self) -> int:
+        """Максимум записей в одном add/upsert с учетом лимита сервера Chroma"""
+        if self._server_batch_limit is None:
+            try:
+                self._server_batch_limit = self.client.get_max_batch_size()
+            except Exception as e:
+                logging.warning(f"Could not get Chroma max batch size: {str(e)}")
+                self._server_batch_limit = WRITE_BATCH_SIZE
+        return max(1, min(WRITE_BATCH_SIZE, self._server_batch_limit))
+
+    @staticmethod
+    def _write_batches(texts: List[str], metadatas: List[Dict[str, Any]],
+                       ids: List[str], embeddings: List[List[float]],
+                       max_records: int) -> List[tuple]:
         """
-        Добавляет документы в коллекцию
+        Разбивает записи на последовательные батчи (start, end)
+        по числу записей и оценке размера тела запроса
+        """
+        batches = []
+        start = 0
+        batch_bytes = 0
+
+        for i in range(len(texts)):
+            size = (len(texts[i].encode('utf-8')) + len(ids[i]) +
+                    len(json.dumps(metadatas[i], ensure_ascii=False)) +
+                    len(embeddings[i]) * EMBEDDING_FLOAT_JSON_BYTES)
+            batch_full = (i - start >= max_records or
+                          batch_bytes + size > WRITE_BATCH_BYTES)
+            if i > start and batch_full:
+                batches.append((start, i))
+                start = i
+                batch_bytes = 0
+            batch_bytes += size
+
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    @staticmethod
+    def _content_id(source: str, index: int, text: str) -> str:
+        """Детерминированный ID чанка: хэш от (source, номер чанка, текст)"""
+        raw = f"{source}\x00{index}\x00{text}".encode('utf-8')
+        return hashlib.sha256(raw).hexdigest()[:32]
+
+    @staticmethod
+    def _existing_ids(collection, ids: List[str], page_size: int = 1000) -> set:
+        """Возвращает те из ids, что уже есть в коллекции (без документов и векторов)"""
+        existing = set()
+        for i in range(0, len(ids), page_size):
+            result = collection.get(ids=ids[i:i + page_size], include=[])
+            existing.update(result['ids'])
+        return existing
+
+    @staticmethod
+    def _source_ids(collection, source: str, page_size: int = 1000) -> set:
+        """Все ID чанков с metadata source == source (постранично, только ID)"""
+        ids = set()
+        offset = 0
+        while True:
+            result = collection.get(where={"source": source}, include=[],
+                                    limit=page_size, offset=offset)
+            ids.update(result['ids'])
+            if len(result['ids']) < page_size:
+                return ids
+            offset += page_size
+
+    @staticmethod
+    def _clean_metadata(meta: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Преобразует метаданные в совместимый формат
+        ChromaDB 0.4.x требует простые типы в метаданных
+        """
+        clean_meta = {}
+        for key, value in meta.items():
+            # Конвертируем все в строки или числа
+            if isinstance(value, (str, int, float, bool)):
+                clean_meta[key] = value
+            else:
+                clean_meta[key] = str(value)
+        return clean_meta
+
+    def ingest(self, collection_name: str,
+               items: Iterable[Tuple[str, Optional[Dict[str, Any]]]],
+               api_key: Optional[str] = None,
+               model_name: Optional[str] = None,
+               deterministic_ids: bool = False,
+               source: Optional[str] = None,
+               incremental: bool = False,
+               on_progress=None,
+               id_namespace: Optional[str] = None,
+               resume_from: int = 0,
+               on_checkpoint=None) -> Dict[str, Any]:
+        """
+        Потоково загружает пары (текст, метаданные) в коллекцию через IngestionPipeline.
+        При deterministic_ids=True ID строятся из хэша (source, номер чанка, текст),
+        запись идет через upsert, а уже существующие чанки не эмбеддятся повторно.
+        source по умолчанию берется из поля "source" метаданных чанка.
+        При incremental=True items - новая версия документа source: сохраненные
+        чанки сравниваются с новыми, добавляются только новые, удаляются только
+        исчезнувшие.
+        id_namespace, resume_from и on_checkpoint используются фоновыми задачами:
+        ID строятся из хэша (id_namespace, номер чанка, текст), первые resume_from
+        чанков считаются записанными, а on_checkpoint получает число чанков,
+        записанных непрерывным префиксом
         """
         try:
+            # Источник открывается и читается до первого чанка еще до создания коллекции:
+            # ошибка чтения (формат, путь, загрузка) не оставляет пустую коллекцию
+            items = iter(items)
+            first = next(items, None)
+            if first is not None:
+                items = itertools.chain([first], items)
+
             # Получаем или создаем коллекцию
             collection = self.client.get_or_create_collection(
                 name=collection_name,
                 metadata={"hnsw:space": "cosine"}
             )
+            # Индекс новой коллекции ведется с первой записи и не требует построения
+            if (self.lexical_index is not None
+                    and not self.lexical_index.is_built(collection_name)
+                    and collection.count() == 0):
+                self.lexical_index.mark_built(collection_name)
 
-            # Генерируем уникальные ID для документов
-            ids = [str(uuid.uuid4()) for _ in texts]
-
-            # Создаем эмбеддинги с использованием переданного api_key и модели
-            embeddings = self._create_embeddings(texts, api_key, model_name)
-
-            # Если метаданные не переданы, создаем пустые
-            if metadata is None:
-                metadata = [{"source": "api"} for _ in texts]
-
-            # Преобразуем метаданные в совместимый формат
-            # ChromaDB 0.4.x требует простые типы в метаданных
-            clean_metadata = []
-            for meta in metadata:
-                clean_meta = {}
-                for key, value in meta.items():
-                    # Конвертируем все в строки или числа
-                    if isinstance(value, (str, int, float, bool)):
-                        clean_meta[key] = value
-                    else:
-                        clean_meta[key] = str(value)
-                clean_metadata.append(clean_meta)
-
-            # Добавляем документы
-            collection.add(
-                documents=texts,
-                embeddings=embeddings,
-                metadatas=clean_metadata,
-                ids=ids
+            pipeline = IngestionPipeline(
+                self, collection, items,
+                api_key=api_key,
+                model_name=model_name,
+                deterministic_ids=deterministic_ids,
+                source=source,
+                incremental=incremental,
+                batch_size=PIPELINE_BATCH_SIZE,
+                embed_workers=EMBEDDING_CONCURRENCY,
+                queue_size=PIPELINE_QUEUE_SIZE,
+                threaded=WRITE_PIPELINE,
+                on_progress=on_progress,
+                id_namespace=id_namespace,
+                resume_from=resume_from,
+                on_checkpoint=on_checkpoint
             )
+            report = pipeline.run()
+            stats = report["stats"]
 
             model_used = model_name or os.getenv('CHROMA_MODEL', 'text-embedding-3-large')
 
-            return {
+            result = {
                 "status": "success",
-                "added": len(texts),
-                "ids": ids,
-                "model_used": model_used
+                "added": stats["written"],
+                "skipped": stats["skipped"],
+                "ids": pipeline.ids,
+                "model_used": model_used,
+                "timings": report["timings"]
             }
+            if incremental:
+                result["deleted"] = stats["deleted"]
+            return result
 
         except Exception as e:
-            logging.error(f"Error adding documents: {str(e)}")
+            logging.error(f"Error ingesting documents: {str(e)}")
             raise
 
-    def delete_documents(self, collection_name: str, filters: Dict[str, Any]) -> Dict[str, Any]:
+    def add_documents(self, collection_name: str, texts: List[str],
+                      metadata: Optional[List[Dict[str, Any]]] = None,
+                      api_key: Optional[str] = None,
+                      model_name: Optional[str] = None,
+                      deterministic_ids: bool = False,
+                      source: Optional[str] = None,
+                      incremental: bool = False,
+                      on_progress=None,
+                      id_namespace: Optional[str] = None,
+                      resume_from: int = 0,
+                      on_checkpoint=None,
+                      **kwargs) -> Dict[str, Any]:
         """
-        Удаляет документы из коллекции по фильтру
+        Добавляет документы в коллекцию (режимы ID - см. ingest)
         """
         try:
-            collection = self.client.get_collection(name=collection_name)
+            # Если метаданные не переданы, создаем пустые
+            if metadata is None:
+                metadata = [None] * len(texts)
 
-            # Получаем документы по фильтру
-            result = collection.get(**filters)
+            return self.ingest(
+                collection_name,
+                zip(texts, metadata),
+                api_key=api_key,
+                model_name=model_name,
+                deterministic_ids=deterministic_ids,
+                source=source,
+                incremental=incremental,
+                on_progress=on_progress,
+                id_namespace=id_namespace,
+                resume_from=resume_from,
+                on_checkpoint=on_checkpoint
+            )
 
-            if result['ids']:
-                # Удаляем найденные документы
-                collection.delete(ids=result['ids'])
+        except Exception as e:
+            logging.error(f"Error adding documents: {str(e)}")
+            raise
 
-                return {
-                    "status": "success",
-                    "deleted": len(result['ids']),
-                    "ids": result['ids']
-                }
+    def delete_documents(self, collection_name: str, filters: Dict[str, Any],
+                         return_ids: bool = False) -> Dict[str, Any]:
+        """
+        Удаляет документы из коллекции по фильтру (where, where_document, ids,
+        limit, offset). Совпадающие записи выбираются страницами по DELETE_BATCH_SIZE
+        без текста и метаданных (только ID) и удаляются по странице за раз; первые
+        offset совпадений не удаляются. Список удаленных ID возвращается только при return_ids
+        """
+        try:
+            collection = self.client.get_collection(name=collection_name)
+            params = {key: filters[key] for key in ('where', 'where_document', 'ids')
+                      if key in filters}
+            limit = filters.get('limit')
+            offset = filters.get('offset') or 0
 
-            return {
+            deleted = 0
+            deleted_ids = []
+            try:
+                while limit is None or deleted < limit:
+                    page_size = DELETE_BATCH_SIZE if limit is None \
+                        else min(DELETE_BATCH_SIZE, limit - deleted)
+                    # offset каждый раз тот же: первые offset совпадений остаются,
+                    # а удаленные записи выпадают из следующей выборки
+                    ids = collection.get(limit=page_size, offset=offset, include=[],
+                                         **params)['ids']
+                    if not ids:
+                        break
+                    collection.delete(ids=ids)
+                    if self.lexical_index is not None:
+                        self.lexical_index.delete(collection_name, ids)
+                    deleted += len(ids)
+                    if return_ids:
+                        deleted_ids.extend(ids)
+                    if len(ids) < page_size:
+                        break
+            finally:
+                # Часть страниц могла быть удалена и при ошибке
+                if deleted:
+                    self.query_cache.invalidate(collection_name)
+
+            result = {
                 "status": "success",
-                "deleted": 0,
-                "ids": []
+                "deleted": deleted
             }
+            if return_ids:
+                result["ids"] = deleted_ids
+            return result
 
         except Exception as e:
             logging.error(f"Error deleting documents: {str(e)}")
@@ -168,6 +1136,9 @@ class ChromaManager:
         """
         try:
             self.client.delete_collection(name=collection_name)
+            self.query_cache.invalidate(collection_name)
+            if self.lexical_index is not None:
+                self.lexical_index.drop(collection_name)
             return {
                 "status": "success",
                 "message": f"Collection {collection_name} deleted"
@@ -176,18 +1147,111 @@ class ChromaManager:
             logging.error(f"Error deleting collection: {str(e)}")
             raise
 
-    def get_documents(self, collection_name: str, filters: Dict[str, Any]) -> Dict[str, Any]:
+    @staticmethod
+    def encode_cursor(offset: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> int:
+        try:
+            offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"]
+        except Exception:
+            raise ValueError("Invalid cursor")
+        if not isinstance(offset, int) or offset < 0:
+            raise ValueError("Invalid cursor")
+        return offset
+
+    @staticmethod
+    def _get_params(filters: Dict[str, Any], include: Optional[List[str]]) -> Dict[str, Any]:
+        """Параметры collection.get: фильтры where/where_document/ids и проекция полей"""
+        params = {key: filters[key] for key in ('where', 'where_document', 'ids')
+                  if key in filters}
+        # include можно передать и в filters (прежний формат, filters уходили в collection.get)
+        if include is None:
+            include = filters.get('include')
+        params["include"] = list(include) if include is not None else ['documents', 'metadatas']
+        return params
+
+    @staticmethod
+    def _jsonable_page(page: Dict[str, Any], include: List[str]) -> Dict[str, Any]:
+        result = {"ids": page['ids']}
+        for field in include:
+            values = page.get(field)
+            if field == 'embeddings' and values is not None:
+                # Chroma возвращает эмбеддинги массивами numpy
+                values = [[float(x) for x in vector] for vector in values]
+            result[field] = values
+        result["included"] = include
+        return result
+
+    def get_documents(self, collection_name: str, filters: Dict[str, Any],
+                      include: Optional[List[str]] = None,
+                      limit: Optional[int] = None,
+                      offset: Optional[int] = None) -> Dict[str, Any]:
         """
-        Получает документы из коллекции по фильтру
+        Получает документы из коллекции по фильтру, одной страницей.
+        limit/offset можно передать и в filters (прежний формат); limit ограничен
+        SHOW_COLLECTION_MAX_LIMIT. include - какие поля вернуть (ID возвращаются всегда).
+        Если записей могло быть больше, в ответе есть next_cursor для следующей страницы;
+        truncated=True - страница обрезана лимитом SHOW_COLLECTION_MAX_LIMIT, а не limit запроса
         """
         try:
             collection = self.client.get_collection(name=collection_name)
-            result = collection.get(**filters)
+            params = self._get_params(filters, include)
+            requested = limit if limit is not None else filters.get('limit')
+            offset = offset if offset is not None else filters.get('offset', 0)
+            limit = min(requested or SHOW_COLLECTION_MAX_LIMIT, SHOW_COLLECTION_MAX_LIMIT)
+
+            page = collection.get(limit=limit, offset=offset, **params)
+            result = self._jsonable_page(page, params["include"])
+            if len(page['ids']) == limit:
+                result["next_cursor"] = self.encode_cursor(offset + limit)
+                if not requested or requested > limit:
+                    result["truncated"] = True
+                    logging.warning(f"show_collection {collection_name}: page truncated to "
+                                    f"{limit} records, next_cursor returned")
             return result
         except Exception as e:
             logging.error(f"Error getting documents: {str(e)}")
             raise
 
+    def iter_documents(self, collection_name: str, filters: Dict[str, Any],
+                       include: Optional[List[str]] = None,
+                       limit: Optional[int] = None,
+                       offset: int = 0) -> Iterable[Dict[str, Any]]:
+        """
+        Потоковая выгрузка: читает коллекцию страницами по SHOW_COLLECTION_PAGE_SIZE
+        и отдает записи {"id", "document", "metadata", "embedding"} по одной,
+        поэтому память не зависит от размера коллекции.
+        Коллекция открывается сразу, чтобы ошибка была до начала потока
+        """
+        collection = self.client.get_collection(name=collection_name)
+        params = self._get_params(filters, include)
+        fields = [(field, field[:-1]) for field in params["include"]]
+
+        def records():
+            position = offset
+            remaining = limit
+            while remaining is None or remaining > 0:
+                page_size = SHOW_COLLECTION_PAGE_SIZE if remaining is None \
+                    else min(SHOW_COLLECTION_PAGE_SIZE, remaining)
+                page = self._jsonable_page(
+                    collection.get(limit=page_size, offset=position, **params),
+                    params["include"]
+                )
+                for i, doc_id in enumerate(page['ids']):
+                    record = {"id": doc_id}
+                    for field, name in fields:
+                        record[name] = page[field][i] if page[field] is not None else None
+                    yield record
+                if len(page['ids']) < page_size:
+                    return
+                position += page_size
+                if remaining is not None:
+                    remaining -= page_size
+
+        return records()
+
     def count_documents(self, collection_name: str) -> Dict[str, Any]:
         """
         Подсчитывает количество документов в коллекции
@@ -203,54 +1267,419 @@ class ChromaManager:
             logging.error(f"Error counting documents: {str(e)}")
             raise
 
+    def _embed_queries(self, query_texts: List[str], api_key: Optional[str] = None,
+                       model_name: Optional[str] = None) -> List[List[float]]:
+        """
+        Эмбеддинги поисковых запросов. Кэш ключуется нормализованным текстом,
+        поэтому запросы, отличающиеся только пробелами (и регистром, если включено),
+        делят запись кэша; в OpenAI отправляется исходный текст.
+        Промахи кэша отправляются в OpenAI одним батчем
+        """
+        model_used = model_name or os.getenv('CHROMA_MODEL', 'text-embedding-3-large')
+        keys = [_normalize_query(text) for text in query_texts]
+        embeddings = [self.query_embedding_cache.get(model_used, key) for key in keys]
+        # Для каждого ключа-промаха эмбеддится первый запрос с этим ключом
+        missing = {}
+        for key, text, embedding in zip(keys, query_texts, embeddings):
+            if embedding is None:
+                missing.setdefault(key, text)
+        if missing:
+            created = dict(zip(missing, self._create_embeddings(list(missing.values()),
+                                                                api_key=api_key,
+                                                                model_name=model_used)))
+            for key, embedding in created.items():
+                self.query_embedding_cache.put(model_used, key, embedding)
+            embeddings = [embedding if embedding is not None else created[key]
+                          for key, embedding in zip(keys, embeddings)]
+        return embeddings
+
+    def _embed_query(self, query_text: str, api_key: Optional[str] = None,
+                     model_name: Optional[str] = None) -> List[float]:
+        """Эмбеддинг одного поискового запроса (с кэшем запросов)"""
+        return self._embed_queries([query_text], api_key, model_name)[0]
+
+    @staticmethod
+    def _query_cache_key(query_embedding: List[float], n_results: int,
+                         filters: Dict[str, Any]) -> str:
+        # Ключ - хэш эмбеддинга, а не текст: разные формулировки,
+        # давшие тот же вектор, делят запись кэша
+        return QueryResultCache.make_key(
+            hashlib.sha256(EmbeddingCache.pack(query_embedding)).hexdigest(),
+            n_results, filters.get('where'), filters.get('where_document')
+        )
+
+    def query_batch(self, queries: List[Dict[str, Any]], api_key: Optional[str] = None,
+                    model_name: Optional[str] = None,
+                    use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Пакетный поиск: queries - список {"collection_name", "query", "n_results", "filters"}.
+        Все запросы эмбеддятся одним вызовом OpenAI, затем на каждую коллекцию
+        (с одинаковыми фильтрами) выполняется один collection.query со всеми
+        эмбеддингами. Результаты возвращаются в порядке запросов
+        """
+        try:
+            model_used = model_name or os.getenv('CHROMA_MODEL', 'text-embedding-3-large')
+            versions = {}
+            if use_cache:
+                for query in queries:
+                    name = query['collection_name']
+                    if name not in versions:
+                        versions[name] = self.query_cache.version(name)
+
+            embeddings = self._embed_queries([query['query'] for query in queries],
+                                             api_key, model_name)
+
+            results = [None] * len(queries)
+            cache_keys = [None] * len(queries)
+            groups = {}
+            for i, (query, embedding) in enumerate(zip(queries, embeddings)):
+                filters = query.get('filters') or {}
+                n_results = query.get('n_results', 4)
+                if use_cache:
+                    cache_keys[i] = self._query_cache_key(embedding, n_results, filters)
+                    cached = self.query_cache.get(query['collection_name'],
+                                                  versions[query['collection_name']],
+                                                  cache_keys[i])
+                    if cached is not None:
+                        results[i] = dict(cached['results'],
+                                          collection_name=query['collection_name'])
+                        continue
+                group = (query['collection_name'],
+                         json.dumps(filters.get('where'), sort_keys=True),
+                         json.dumps(filters.get('where_document'), sort_keys=True))
+                groups.setdefault(group, []).append(i)
+
+            for (collection_name, _, _), indexes in groups.items():
+                collection = self.client.get_collection(name=collection_name)
+                filters = queries[indexes[0]].get('filters') or {}
+                # Один запрос на группу с максимальным n_results, лишнее отрезается
+                query_params = {
+                    "query_embeddings": [embeddings[i] for i in indexes],
+                    "n_results": max(queries[i].get('n_results', 4) for i in indexes),
+                    "include": ['documents', 'metadatas', 'distances']
+                }
+                for key in ['where', 'where_document']:
+                    if key in filters:
+                        query_params[key] = filters[key]
+                response = collection.query(**query_params)
+
+                for row, i in enumerate(indexes):
+                    n_results = queries[i].get('n_results', 4)
+                    result = {
+                        "documents": response['documents'][row][:n_results],
+                        "metadatas": response['metadatas'][row][:n_results],
+                        "distances": response['distances'][row][:n_results],
+                        "ids": response['ids'][row][:n_results],
+                        "model_used": model_used
+                    }
+                    if use_cache:
+                        self.query_cache.put(collection_name, versions[collection_name],
+                                             cache_keys[i], {"status": "success", "results": result})
+                    results[i] = dict(result, collection_name=collection_name)
+
+            return {"status": "success", "results": results}
+
+        except Exception as e:
+            logging.error(f"Error in batch query: {str(e)}")
+            raise
+
+    def _query_by_embedding(self, collection_name: str, query_embedding: List[float],
+                            n_results: int, model_used: str,
+                            filters: Optional[dict] = None,
+                            use_cache: bool = True,
+                            include_embeddings: bool = False) -> Dict[str, Any]:
+        """
+        Поиск в коллекции по готовому эмбеддингу запроса (с кэшем результатов).
+        include_embeddings - вернуть и эмбеддинги найденных чанков (без кэша)
+        """
+        filters = filters or {}
+        use_cache = use_cache and not include_embeddings
+        if use_cache:
+            # Поколение берется до запроса к Chroma, чтобы результат, посчитанный
+            # во время изменения коллекции, не попал в кэш под новым поколением
+            cache_version = self.query_cache.version(collection_name)
+            cache_key = self._query_cache_key(query_embedding, n_results, filters)
+            cached = self.query_cache.get(collection_name, cache_version, cache_key)
+            if cached is not None:
+                return cached
+
+        collection = self.client.get_collection(name=collection_name)
+
+        # Готовим параметры запроса
+        query_params = {
+            "query_embeddings": [query_embedding],
+            "n_results": n_results,
+            "include": ['documents', 'metadatas', 'distances']
+        }
+        if include_embeddings:
+            query_params["include"].append('embeddings')
+
+        # Если фильтры переданы, добавляем их (поддерживаются ключи "where" и "where_document")
+        for key in ['where', 'where_document']:
+            if key in filters:
+                query_params[key] = filters[key]
+
+        # Выполняем запрос с учетом фильтров
+        results = collection.query(**query_params)
+
+        response = {
+            "status": "success",
+            "results": {
+                "documents": results['documents'][0],
+                "metadatas": results['metadatas'][0],
+                "distances": results['distances'][0],
+                "ids": results['ids'][0],
+                "model_used": model_used
+            }
+        }
+        if include_embeddings:
+            response["results"]["embeddings"] = results['embeddings'][0]
+        if use_cache:
+            self.query_cache.put(collection_name, cache_version, cache_key, response)
+        return response
+
     def query_collection(self, collection_name: str, query_text: str,
                          n_results: int = 4, api_key: Optional[str] = None,
                          model_name: Optional[str] = None,
-                         filters: Optional[dict] = None) -> Dict[str, Any]:
+                         filters: Optional[dict] = None,
+                         use_cache: bool = True,
+                         mode: str = 'vector',
+                         rerank: Optional[str] = None,
+                         rerank_factor: Optional[int] = None,
+                         mmr: bool = False,
+                         mmr_lambda: float = 0.5) -> Dict[str, Any]:
         """
         Поиск релевантных документов по запросу с учетом фильтров.
         Если в filters переданы ключи "where" или "where_document", они будут добавлены
         в параметры запроса к коллекции.
+        Результаты кэшируются до изменения коллекции (use_cache=False - без кэша).
+        mode: vector - по эмбеддингам, lexical - BM25, hybrid - оба с RRF.
+        rerank: имя скорера из rerankers.py - запрашивается n_results x rerank_factor
+        кандидатов, возвращаются n_results лучших по оценке скорера.
+        mmr: из того же расширенного набора кандидатов выбираются n_results
+        разнообразных (maximal marginal relevance, mmr_lambda - вес релевантности)
         """
         try:
-            collection = self.client.get_collection(name=collection_name)
+            model_used = model_name or os.getenv('CHROMA_MODEL', 'text-embedding-3-large')
+            if mmr and (rerank or mode != 'vector'):
+                raise ValueError("mmr is supported only in vector mode without rerank")
+            n_fetch = n_results
+            if rerank:
+                reranker = get_reranker(rerank)
+            if rerank or mmr:
+                n_fetch = n_results * max(1, rerank_factor or RERANK_CANDIDATES_FACTOR)
 
-            # Создаем эмбеддинг для запроса с указанной моделью
-            query_embedding = self._create_embeddings(
-                [query_text],
-                api_key=api_key,
-                model_name=model_name
-            )[0]
-
-            # Готовим параметры запроса
-            query_params = {
-                "query_embeddings": [query_embedding],
-                "n_results": n_results,
-                "include": ['documents', 'metadatas', 'distances']
-            }
+            if mode != 'vector':
+                response = self._hybrid_query(collection_name, query_text, n_fetch, api_key,
+                                              model_name, filters, use_cache, mode)
+            else:
+                # Создаем эмбеддинг для запроса с указанной моделью (с кэшем запросов)
+                query_embedding = self._embed_query(query_text, api_key, model_name)
+                response = self._query_by_embedding(collection_name, query_embedding, n_fetch,
+                                                    model_used, filters, use_cache,
+                                                    include_embeddings=mmr)
+                if mmr:
+                    results = response["results"]
+                    order = mmr_select(query_embedding, results.pop("embeddings"),
+                                       n_results, mmr_lambda)
+                    for key in ('documents', 'metadatas', 'distances', 'ids'):
+                        results[key] = [results[key][i] for i in order]
 
-            # Если фильтры переданы, добавляем их (поддерживаются ключи "where" и "where_document")
-            if filters:
-                for key in ['where', 'where_document']:
-                    if key in filters:
-                        query_params[key] = filters[key]
+            if rerank:
+                response = self._rerank(reranker, query_text, response, n_results)
+            return response
+
+        except Exception as e:
+            logging.error(f"Error querying collection: {str(e)}")
+            raise
+
+    @staticmethod
+    def _rerank(reranker, query_text: str, response: Dict[str, Any],
+                n_results: int) -> Dict[str, Any]:
+        """Переранжирует кандидатов скорером и оставляет n_results лучших"""
+        started = time.perf_counter()
+        results = response["results"]
+        scores = reranker.score(query_text, results["documents"], results["distances"])
+        order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:n_results]
+        reranked = dict(results)
+        for key in ('documents', 'metadatas', 'distances', 'ids', 'scores'):
+            if key in results:
+                reranked[key] = [results[key][i] for i in order]
+        reranked["rerank_scores"] = [round(float(scores[i]), 6) for i in order]
+        reranked["reranker"] = reranker.name
+        logging.info(f"Reranked {len(scores)} candidates with {reranker.name} "
+                     f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+        return {"status": response["status"], "results": reranked}
+
+    def _ensure_lexical_index(self, collection):
+        """Строит BM25 индекс для коллекции, загруженной до его включения"""
+        if self.lexical_index.is_built(collection.name):
+            return
+        started = time.perf_counter()
+        offset = 0
+        while True:
+            page = collection.get(include=['documents'], limit=WRITE_BATCH_SIZE, offset=offset)
+            if not page['ids']:
+                break
+            self.lexical_index.add(collection.name, page['ids'], page['documents'])
+            offset += len(page['ids'])
+        self.lexical_index.mark_built(collection.name)
+        logging.info(f"Lexical index for {collection.name} built: {offset} chunks "
+                     f"in {time.perf_counter() - started:.2f}s")
+
+    def _lexical_hits(self, collection, query_text: str, limit: int,
+                      filters: Dict[str, Any], phrase: bool = False) -> List[Dict[str, Any]]:
+        """
+        BM25 кандидаты с документами и метаданными из Chroma.
+        Фильтры where/where_document применяет Chroma при выборке по ID
+        """
+        ranked = self.lexical_index.search(collection.name, query_text, limit, phrase=phrase)
+        if not ranked:
+            return []
+        get_params = {"ids": [doc_id for doc_id, _ in ranked],
+                      "include": ['documents', 'metadatas']}
+        for key in ['where', 'where_document']:
+            if key in filters:
+                get_params[key] = filters[key]
+        found = collection.get(**get_params)
+        records = {doc_id: (document, meta) for doc_id, document, meta
+                   in zip(found['ids'], found['documents'], found['metadatas'])}
+        return [{"id": doc_id, "document": records[doc_id][0], "metadata": records[doc_id][1],
+                 "score": score}
+                for doc_id, score in ranked if doc_id in records]
+
+    def _hybrid_query(self, collection_name: str, query_text: str, n_results: int,
+                      api_key: Optional[str], model_name: Optional[str],
+                      filters: Optional[dict], use_cache: bool, mode: str) -> Dict[str, Any]:
+        """
+        Лексический (BM25) и гибридный поиск. Гибрид объединяет ранги BM25
+        и векторного поиска через reciprocal rank fusion: score = sum(1 / (RRF_K + rank)).
+        Запрос из одного токена с цифрами (артикул, номер заказа) сначала ищется
+        в индексе фразой; если он найден, эмбеддинг не считается
+        """
+        if mode not in ('lexical', 'hybrid'):
+            raise ValueError(f"Unknown query mode: {mode}")
+        if self.lexical_index is None:
+            raise ValueError("Lexical index is disabled (CHROMA_LEXICAL_INDEX_DIR is not set)")
+        model_used = model_name or os.getenv('CHROMA_MODEL', 'text-embedding-3-large')
+        filters = filters or {}
+        collection = self.client.get_collection(name=collection_name)
+        self._ensure_lexical_index(collection)
+
+        candidates = max(n_results, HYBRID_CANDIDATES)
+        exact = len(query_text.split()) == 1 and any(ch.isdigit() for ch in query_text)
+        if mode == 'lexical' or exact:
+            hits = self._lexical_hits(collection, query_text, n_results, filters, phrase=exact)
+            if mode == 'lexical' or hits:
+                return {
+                    "status": "success",
+                    "results": {
+                        "documents": [hit["document"] for hit in hits],
+                        "metadatas": [hit["metadata"] for hit in hits],
+                        "distances": [None] * len(hits),
+                        "ids": [hit["id"] for hit in hits],
+                        "scores": [hit["score"] for hit in hits],
+                        "mode": "lexical",
+                        "model_used": model_used
+                    }
+                }
 
-            # Выполняем запрос с учетом фильтров
-            results = collection.query(**query_params)
+        lexical = self._lexical_hits(collection, query_text, candidates, filters)
+        query_embedding = self._embed_query(query_text, api_key, model_name)
+        vector = self._query_by_embedding(collection_name, query_embedding, candidates,
+                                          model_used, filters, use_cache)["results"]
+
+        fused = {}
+        for rank, doc_id in enumerate(vector["ids"]):
+            fused[doc_id] = {"id": doc_id, "document": vector["documents"][rank],
+                             "metadata": vector["metadatas"][rank],
+                             "distance": vector["distances"][rank],
+                             "score": 1.0 / (RRF_K + rank + 1)}
+        for rank, hit in enumerate(lexical):
+            entry = fused.setdefault(hit["id"], {"id": hit["id"], "document": hit["document"],
+                                                 "metadata": hit["metadata"],
+                                                 "distance": None, "score": 0.0})
+            entry["score"] += 1.0 / (RRF_K + rank + 1)
+
+        hits = sorted(fused.values(), key=lambda hit: hit["score"], reverse=True)[:n_results]
+        return {
+            "status": "success",
+            "results": {
+                "documents": [hit["document"] for hit in hits],
+                "metadatas": [hit["metadata"] for hit in hits],
+                "distances": [hit["distance"] for hit in hits],
+                "ids": [hit["id"] for hit in hits],
+                "scores": [round(hit["score"], 6) for hit in hits],
+                "mode": "hybrid",
+                "model_used": model_used
+            }
+        }
 
+    def query_collections(self, collection_names: List[str], query_text: str,
+                          n_results: int = 4, api_key: Optional[str] = None,
+                          model_name: Optional[str] = None,
+                          filters: Optional[dict] = None,
+                          use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Федеративный поиск по нескольким коллекциям: запрос эмбеддится один раз,
+        коллекции опрашиваются параллельно, результаты объединяются в общий top-k
+        по расстоянию. Расстояния сравнимы, если коллекции построены одной моделью
+        с одной метрикой. Ошибка одной коллекции не прерывает поиск по остальным
+        """
+        try:
             model_used = model_name or os.getenv('CHROMA_MODEL', 'text-embedding-3-large')
+            collection_names = list(dict.fromkeys(collection_names))
+            query_embedding = self._embed_query(query_text, api_key, model_name)
+
+            def search(collection_name: str) -> Dict[str, Any]:
+                started = time.perf_counter()
+                try:
+                    response = self._query_by_embedding(collection_name, query_embedding,
+                                                        n_results, model_used, filters,
+                                                        use_cache)
+                    return {"results": response["results"],
+                            "took_ms": round((time.perf_counter() - started) * 1000, 2)}
+                except Exception as e:
+                    logging.error(f"Error querying collection {collection_name}: {str(e)}")
+                    return {"error": str(e),
+                            "took_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+            workers = min(len(collection_names), FEDERATED_QUERY_WORKERS)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                responses = list(executor.map(search, collection_names))
 
+            if all("error" in response for response in responses):
+                raise RuntimeError("; ".join(f"{name}: {response['error']}" for name, response
+                                             in zip(collection_names, responses)))
+
+            hits = []
+            collections = {}
+            for collection_name, response in zip(collection_names, responses):
+                collections[collection_name] = {"took_ms": response["took_ms"]}
+                if "error" in response:
+                    collections[collection_name]["error"] = response["error"]
+                    continue
+                results = response["results"]
+                collections[collection_name]["count"] = len(results["ids"])
+                hits.extend(zip(results["distances"], results["documents"],
+                                results["metadatas"], results["ids"],
+                                [collection_name] * len(results["ids"])))
+
+            hits.sort(key=lambda hit: hit[0])
+            hits = hits[:n_results]
             return {
                 "status": "success",
                 "results": {
-                    "documents": results['documents'][0],
-                    "metadatas": results['metadatas'][0],
-                    "distances": results['distances'][0],
-                    "ids": results['ids'][0],
+                    "documents": [hit[1] for hit in hits],
+                    "metadatas": [hit[2] for hit in hits],
+                    "distances": [hit[0] for hit in hits],
+                    "ids": [hit[3] for hit in hits],
+                    "collections": [hit[4] for hit in hits],
                     "model_used": model_used
-                }
+                },
+                "collections": collections
             }
 
         except Exception as e:
-            logging.error(f"Error querying collection: {str(e)}")
+            logging.error(f"Error in federated query: {str(e)}")
             raise
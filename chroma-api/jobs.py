@@ -0,0 +1,305 @@
+from typing import Dict, Any, Optional, Callable
+from contextlib import closing
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from chroma_utils import _env_int
+
+
+# Файл SQLite с очередью задач - в общем томе, чтобы очередь была видна всем воркерам
+# и переживала перезапуск контейнера
+JOBS_DB_PATH = os.getenv('CHROMA_JOBS_DB') or '/data/shared/chroma_jobs.sqlite'
+JOB_WORKERS = max(1, _env_int('CHROMA_JOB_WORKERS', 2))
+JOB_RETENTION_DAYS = _env_int('CHROMA_JOB_RETENTION_DAYS', 7)
+JOB_MAX_ATTEMPTS = max(1, _env_int('CHROMA_JOB_MAX_ATTEMPTS', 3))
+# Аренда задачи (сек): если воркер не продлил ее (упал, контейнер перезапущен),
+# задачу забирает другой воркер и продолжает с последней контрольной точки
+JOB_LEASE_SECONDS = _env_int('CHROMA_JOB_LEASE_SECONDS', 60)
+# Как часто (сек) сохранять прогресс и проверять очередь
+PROGRESS_INTERVAL = 1.0
+POLL_INTERVAL = 1.0
+
+# Поля запроса, которые не сохраняются в очереди (файл лежит на общем томе)
+SECRET_FIELDS = ('openai_api_key',)
+
+# Колонки, добавленные к таблице jobs после первой версии
+_MIGRATIONS = {
+    "payload": "TEXT",
+    "checkpoint": "INTEGER NOT NULL DEFAULT 0",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "owner": "TEXT",
+    "lease_until": "REAL"
+}
+
+
+class JobStore:
+    """
+    Очередь фоновых задач в SQLite: параметры, статус, прогресс и контрольная точка.
+    Файл общий для всех воркеров gunicorn, соединение открывается на каждую операцию
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in _MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            # Параметры завершенных задач больше не нужны, а из остальных
+            # удаляем секреты, сохраненные прежними версиями
+            conn.execute("UPDATE jobs SET payload = NULL "
+                         "WHERE state IN ('completed', 'failed') AND payload IS NOT NULL")
+            for field in SECRET_FIELDS:
+                conn.execute("UPDATE jobs SET payload = json_remove(payload, ?) "
+                             "WHERE json_extract(payload, ?) IS NOT NULL",
+                             (f"$.{field}", f"$.{field}"))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, kind: str, payload: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        payload = {key: value for key, value in payload.items() if key not in SECRET_FIELDS}
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, state, progress, payload, created_at, updated_at) "
+                "VALUES (?, ?, 'queued', '{}', ?, ?, ?)",
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            # Заодно удаляем давно завершенные задачи
+            conn.execute(
+                "DELETE FROM jobs WHERE state IN ('completed', 'failed') AND updated_at < ?",
+                (now - JOB_RETENTION_DAYS * 86400,)
+            )
+        return job_id
+
+    def claim(self, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        Атомарно забирает следующую задачу: новую или выполнявшуюся, чья аренда истекла.
+        Задачи, исчерпавшие JOB_MAX_ATTEMPTS попыток, помечаются failed
+        """
+        with closing(self._connect()) as conn:
+            conn.isolation_level = None
+            while True:
+                now = time.time()
+                # BEGIN IMMEDIATE - только один воркер выбирает задачу в момент времени
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = conn.execute(
+                        "SELECT * FROM jobs WHERE state = 'queued' "
+                        "OR (state = 'running' AND lease_until < ?) "
+                        "ORDER BY created_at LIMIT 1",
+                        (now,)
+                    ).fetchone()
+                    if row is None:
+                        conn.execute("COMMIT")
+                        return None
+                    if row["attempts"] >= JOB_MAX_ATTEMPTS:
+                        conn.execute(
+                            "UPDATE jobs SET state = 'failed', error = ?, payload = NULL, "
+                            "updated_at = ? WHERE id = ?",
+                            (f"Job abandoned after {row['attempts']} attempts", now, row["id"])
+                        )
+                        conn.execute("COMMIT")
+                        continue
+                    conn.execute(
+                        "UPDATE jobs SET state = 'running', owner = ?, lease_until = ?, "
+                        "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (owner, now + JOB_LEASE_SECONDS, now, row["id"])
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                return {
+                    "job_id": row["id"],
+                    "kind": row["kind"],
+                    "payload": json.loads(row["payload"] or '{}'),
+                    "checkpoint": row["checkpoint"],
+                    "attempts": row["attempts"] + 1
+                }
+
+    def renew(self, job_id: str, owner: str) -> bool:
+        """Продлевает аренду задачи; False - задачу уже забрал другой воркер"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND state = 'running'",
+                (now + JOB_LEASE_SECONDS, job_id, owner)
+            )
+            return cursor.rowcount == 1
+
+    def update(self, job_id: str, state: Optional[str] = None,
+               progress: Optional[Dict[str, Any]] = None,
+               result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None,
+               checkpoint: Optional[int] = None):
+        fields = {"updated_at": time.time()}
+        if state is not None:
+            fields["state"] = state
+            if state in ('completed', 'failed'):
+                # Параметры нужны только для возобновления задачи
+                fields["payload"] = None
+        if progress is not None:
+            fields["progress"] = json.dumps(progress)
+        if result is not None:
+            fields["result"] = json.dumps(result, ensure_ascii=False)
+        if error is not None:
+            fields["error"] = error
+        if checkpoint is not None:
+            fields["checkpoint"] = checkpoint
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?",
+                         (*fields.values(), job_id))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "state": row["state"],
+            "progress": json.loads(row["progress"] or '{}'),
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "checkpoint": row["checkpoint"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+
+class JobManager:
+    """
+    Выполняет задачи из очереди JobStore в фоновых потоках воркера.
+    Каждый воркер gunicorn забирает задачи из общей очереди, поэтому задачи,
+    прерванные падением или перезапуском, продолжаются другим воркером или
+    после старта контейнера (at-least-once).
+    handlers: {kind: функция(data, on_progress=..., id_namespace=...,
+    resume_from=..., on_checkpoint=...) -> dict с результатом}
+    """
+
+    def __init__(self, store: JobStore, handlers: Dict[str, Callable], workers: int = JOB_WORKERS):
+        self.store = store
+        self.handlers = handlers
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Запускает потоки, которые берут задачи из очереди (включая прерванные ранее)"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"chroma-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Job workers started: {self.owner} x{self.workers}")
+
+    def submit(self, kind: str, data: Dict[str, Any]) -> str:
+        """Сохраняет задачу в очередь и сразу возвращает ее ID"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = self.store.create(kind, data)
+        self._wakeup.set()
+        logging.info(f"Job {job_id} ({kind}) queued")
+        return job_id
+
+    def _loop(self):
+        while True:
+            try:
+                job = self.store.claim(self.owner)
+            except Exception as e:
+                logging.error(f"Error claiming job: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _heartbeat(self, job_id: str, stop: threading.Event):
+        """Продлевает аренду, пока задача выполняется"""
+        while not stop.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                if not self.store.renew(job_id, self.owner):
+                    logging.warning(f"Job {job_id} lease lost")
+            except Exception as e:
+                logging.warning(f"Error renewing job {job_id} lease: {str(e)}")
+
+    def _run(self, job: Dict[str, Any]):
+        job_id = job["job_id"]
+        kind = job["kind"]
+        if job["checkpoint"]:
+            logging.info(f"Job {job_id} ({kind}) resumed from chunk {job['checkpoint']}, "
+                         f"attempt {job['attempts']}")
+
+        lock = threading.Lock()
+        state = {"progress": {}, "saved_at": 0.0}
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop), daemon=True)
+        heartbeat.start()
+
+        def on_progress(progress: Dict[str, int]):
+            # Сохраняем прогресс не чаще PROGRESS_INTERVAL, чтобы не нагружать SQLite
+            now = time.monotonic()
+            with lock:
+                state["progress"] = progress
+                if now - state["saved_at"] < PROGRESS_INTERVAL:
+                    return
+                state["saved_at"] = now
+            self.store.update(job_id, progress=progress)
+
+        def on_checkpoint(chunks_written: int):
+            self.store.update(job_id, checkpoint=chunks_written)
+
+        try:
+            # ID чанков строятся от job_id, поэтому повторная запись
+            # после возобновления идемпотентна
+            result = self.handlers[kind](
+                job["payload"],
+                on_progress=on_progress,
+                id_namespace=job_id,
+                resume_from=job["checkpoint"],
+                on_checkpoint=on_checkpoint
+            )
+            self.store.update(job_id, state='completed',
+                              progress=state["progress"], result=result)
+            logging.info(f"Job {job_id} ({kind}) completed")
+        except Exception as e:
+            logging.error(f"Job {job_id} ({kind}) failed: {str(e)}")
+            self.store.update(job_id, state='failed',
+                              progress=state["progress"], error=str(e))
+        finally:
+            stop.set()
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(job_id)
@@ -0,0 +1,124 @@
+from typing import List, Tuple, Iterable
+from contextlib import closing
+import logging
+import os
+import re
+import sqlite3
+
+
+# Токены запроса для FTS5: буквы/цифры, как их выделяет токенайзер unicode61
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def query_tokens(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.casefold())
+
+
+class LexicalIndex:
+    """
+    BM25 индекс (SQLite FTS5) рядом с коллекциями Chroma: один файл на коллекцию.
+    Ведется инкрементально при записи и удалении чанков и нужен для гибридного
+    поиска, чтобы находить артикулы, номера заказов и другие точные токены,
+    которые плохо ловятся эмбеддингами. Соединение открывается на каждую операцию
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, collection_name: str) -> str:
+        # Имена коллекций Chroma состоят из [a-zA-Z0-9._-] и безопасны как имена файлов
+        return os.path.join(self.directory, f"{collection_name}.sqlite")
+
+    def _connect(self, collection_name: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._path(collection_name), timeout=30)
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    rowid INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    document TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            # FTS5 с внешним содержимым: текст хранится один раз в docs,
+            # индекс поддерживается триггерами
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+                    document, content='docs', content_rowid='rowid',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+                    INSERT INTO docs_fts(rowid, document) VALUES (new.rowid, new.document);
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+                    INSERT INTO docs_fts(docs_fts, rowid, document)
+                    VALUES ('delete', old.rowid, old.document);
+                END
+            """)
+        return conn
+
+    def is_built(self, collection_name: str) -> bool:
+        """True, если индекс содержит все чанки коллекции (построен или создан вместе с ней)"""
+        if not os.path.exists(self._path(collection_name)):
+            return False
+        with closing(self._connect(collection_name)) as conn:
+            row = conn.execute("SELECT value FROM state WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def mark_built(self, collection_name: str):
+        with closing(self._connect(collection_name)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('built', '1')")
+
+    def add(self, collection_name: str, ids: List[str], documents: List[str]):
+        """Добавляет или заменяет чанки (по ID)"""
+        with closing(self._connect(collection_name)) as conn, conn:
+            conn.executemany("DELETE FROM docs WHERE id = ?", ((doc_id,) for doc_id in ids))
+            conn.executemany("INSERT INTO docs (id, document) VALUES (?, ?)",
+                             zip(ids, (document or '' for document in documents)))
+
+    def delete(self, collection_name: str, ids: Iterable[str]):
+        if not os.path.exists(self._path(collection_name)):
+            return
+        with closing(self._connect(collection_name)) as conn, conn:
+            conn.executemany("DELETE FROM docs WHERE id = ?", ((doc_id,) for doc_id in ids))
+
+    def drop(self, collection_name: str):
+        """Удаляет индекс коллекции вместе с файлами WAL"""
+        path = self._path(collection_name)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"Error removing lexical index {path + suffix}: {str(e)}")
+
+    def search(self, collection_name: str, query: str, limit: int,
+               phrase: bool = False) -> List[Tuple[str, float]]:
+        """
+        BM25 поиск: [(id, score)] по убыванию релевантности.
+        phrase=True - все токены запроса подряд (точный поиск кода/номера),
+        иначе - любой из токенов
+        """
+        tokens = query_tokens(query)
+        if not tokens or not os.path.exists(self._path(collection_name)):
+            return []
+        if phrase:
+            match = '"' + ' '.join(tokens) + '"'
+        else:
+            match = ' OR '.join(f'"{token}"' for token in tokens)
+        with closing(self._connect(collection_name)) as conn:
+            rows = conn.execute(
+                "SELECT docs.id, bm25(docs_fts) FROM docs_fts "
+                "JOIN docs ON docs.rowid = docs_fts.rowid "
+                "WHERE docs_fts MATCH ? ORDER BY bm25(docs_fts) LIMIT ?",
+                (match, limit)
+            ).fetchall()
+        # bm25() в SQLite возвращает отрицательные значения: меньше - лучше
+        return [(doc_id, -score) for doc_id, score in rows]
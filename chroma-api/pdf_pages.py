@@ -0,0 +1,70 @@
+from typing import List
+import io
+import mmap
+
+import PyPDF2
+
+# Модуль загружается в каждый процесс пула извлечения PDF (spawn), поэтому
+# импортирует только PyPDF2: readers тянет langchain и стоит ~1 с на процесс
+
+
+class MappedFile(io.RawIOBase):
+    """
+    Файл только для чтения поверх mmap. Парсеры PDF/DOCX читают прямо из
+    отображенных страниц, без копирования всего файла в bytes и BytesIO;
+    getbuffer() отдает содержимое без копии для декодирования текста
+    """
+
+    def __init__(self, file):
+        super().__init__()
+        self._file = file
+        # Пустой файл отобразить нельзя - mmap выбросит ValueError
+        self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        return self._map.read(size if size is not None and size >= 0 else None)
+
+    def readinto(self, buffer) -> int:
+        data = self._map.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self) -> int:
+        return self._map.tell()
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._map)
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+            self._file.close()
+        super().close()
+
+
+def map_file(file):
+    """MappedFile поверх открытого файла; пустой файл или ФС без mmap - сам файл"""
+    try:
+        return MappedFile(file)
+    except (ValueError, OSError):
+        return file
+
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """
+    Извлекает текст страниц [start, stop) в процессе пула. Каждый процесс
+    открывает PDF сам (через mmap), поэтому общий поток не разделяется
+    """
+    with map_file(open(path, 'rb')) as pdf_file:
+        pdf_reader = PyPDF2.PdfReader(pdf_file)
+        return [pdf_reader.pages[i].extract_text() for i in range(start, stop)]
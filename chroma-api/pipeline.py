@@ -0,0 +1,318 @@
+from typing import Dict, Any, Optional, Iterable, Tuple, Callable
+import hashlib
+import logging
+import queue
+import threading
+import time
+import uuid
+
+# Маркер конца потока в очередях между этапами
+_DONE = object()
+
+
+class IngestionPipeline:
+    """
+    Потоковый конвейер загрузки: чтение/разбиение → эмбеддинги → запись в Chroma.
+    Этапы связаны ограниченными очередями, поэтому в памяти одновременно
+    находится лишь несколько батчей, а эмбеддинг идет параллельно с чтением
+    исходного файла и записью предыдущих батчей
+    """
+
+    def __init__(self, manager, collection, items: Iterable[Tuple[str, Optional[Dict[str, Any]]]],
+                 api_key: Optional[str] = None,
+                 model_name: Optional[str] = None,
+                 deterministic_ids: bool = False,
+                 source: Optional[str] = None,
+                 incremental: bool = False,
+                 batch_size: int = 256,
+                 embed_workers: int = 1,
+                 queue_size: int = 2,
+                 threaded: bool = True,
+                 on_progress: Optional[Callable[[Dict[str, int]], None]] = None,
+                 id_namespace: Optional[str] = None,
+                 resume_from: int = 0,
+                 on_checkpoint: Optional[Callable[[int], None]] = None):
+        self.manager = manager
+        self.collection = collection
+        self.items = items
+        self.api_key = api_key
+        self.model_name = model_name
+        self.deterministic_ids = deterministic_ids
+        self.source = source
+        self.incremental = incremental
+        self.batch_size = max(1, batch_size)
+        self.embed_workers = max(1, embed_workers)
+        self.queue_size = max(1, queue_size)
+        self.threaded = threaded
+        self.on_progress = on_progress
+        # id_namespace (например, ID фоновой задачи) делает ID воспроизводимыми
+        # при повторном запуске; resume_from - сколько первых чанков уже записано
+        self.id_namespace = id_namespace
+        self.resume_from = max(0, resume_from)
+        self.on_checkpoint = on_checkpoint
+
+        # upsert делает повторную запись тех же ID идемпотентной
+        if deterministic_ids or incremental or id_namespace:
+            self.write = collection.upsert
+            self.rollback_on_error = False
+        else:
+            # Случайные ID: при ошибке записанные батчи удаляются, чтобы повтор
+            # запроса клиентом не дублировал векторы (загрузка "все или ничего")
+            self.write = collection.add
+            self.rollback_on_error = True
+
+        self.ids = []
+        self.stats = {"read": 0, "embedded": 0, "written": 0, "skipped": 0, "deleted": 0,
+                      "errors": 0}
+        self.timings = {"read": 0.0, "embed": 0.0, "write": 0.0}
+        self._existing = set()
+        self._occurrences = {}
+        self._written_ids = []
+        # Завершенные батчи {номер: чанков прочитано до конца батча} для контрольной точки
+        self._completed = {}
+        self._next_seq = 0
+        self._lock = threading.Lock()
+        self._failed = threading.Event()
+        self._errors = []
+
+    def _count(self, stage: str, value: int, seconds: float = 0.0, timing: Optional[str] = None):
+        with self._lock:
+            self.stats[stage] += value
+            if timing:
+                self.timings[timing] += seconds
+            snapshot = dict(self.stats)
+        if self.on_progress:
+            self.on_progress(snapshot)
+
+    def _make_id(self, text: str, meta: Dict[str, Any]) -> str:
+        index = len(self.ids)
+        if self.incremental:
+            # Номер повтора текста вместо позиции - правка в одном месте
+            # документа не меняет ID остальных чанков
+            meta['source'] = self.source
+            # Счетчик повторов ключуется хэшем: полный текст всех чанков в памяти не держим
+            digest = hashlib.sha256(text.encode('utf-8')).digest()
+            index = self._occurrences.get(digest, 0)
+            self._occurrences[digest] = index + 1
+            return self.manager._content_id(self.source, index, text)
+        if self.deterministic_ids:
+            source = self.source or str(meta.get('source', ''))
+            return self.manager._content_id(source, index, text)
+        if self.id_namespace:
+            return self.manager._content_id(self.id_namespace, index, text)
+        return str(uuid.uuid4())
+
+    def _read_batches(self):
+        """
+        Этап чтения: забирает чанки из источника и группирует их в батчи.
+        Отдает (номер батча, чанков прочитано до конца батча, батч);
+        первые resume_from чанков только получают ID и не обрабатываются
+        """
+        batch = {"documents": [], "metadatas": [], "ids": []}
+        iterator = iter(self.items)
+        seq = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                text, meta = next(iterator)
+            except StopIteration:
+                break
+            # Если метаданные не переданы, используем источник по умолчанию
+            meta = self.manager._clean_metadata(meta or {"source": "api"})
+            doc_id = self._make_id(text, meta)
+            self.ids.append(doc_id)
+            if len(self.ids) <= self.resume_from:
+                self._count("read", 1, time.perf_counter() - started, "read")
+                continue
+            batch["documents"].append(text)
+            batch["metadatas"].append(meta)
+            batch["ids"].append(doc_id)
+            self._count("read", 1, time.perf_counter() - started, "read")
+
+            if len(batch["ids"]) >= self.batch_size:
+                yield seq, len(self.ids), batch
+                seq += 1
+                batch = {"documents": [], "metadatas": [], "ids": []}
+
+        if batch["ids"]:
+            yield seq, len(self.ids), batch
+
+    def _embed(self, item: tuple) -> tuple:
+        """Этап эмбеддингов: отбрасывает уже сохраненные чанки и эмбеддит остальные"""
+        seq, end, batch = item
+        started = time.perf_counter()
+        if self.incremental:
+            existing = self._existing
+        elif self.deterministic_ids:
+            existing = self.manager._existing_ids(self.collection, batch["ids"])
+        else:
+            existing = ()
+
+        keep = [i for i, doc_id in enumerate(batch["ids"]) if doc_id not in existing]
+        skipped = len(batch["ids"]) - len(keep)
+        if skipped:
+            self._count("skipped", skipped)
+        if not keep:
+            return seq, end, None
+        if skipped:
+            batch = {key: [values[i] for i in keep] for key, values in batch.items()}
+
+        batch["embeddings"] = self.manager._create_embeddings(
+            batch["documents"], self.api_key, self.model_name
+        )
+        self._count("embedded", len(keep), time.perf_counter() - started, "embed")
+        return seq, end, batch
+
+    def _write(self, item: tuple):
+        """Этап записи: пишет батч в Chroma частями, ограниченными по числу записей и байтам"""
+        seq, end, batch = item
+        if batch is not None:
+            started = time.perf_counter()
+            max_records = self.manager._max_write_batch()
+            for start, stop in self.manager._write_batches(batch["documents"], batch["metadatas"],
+                                                           batch["ids"], batch["embeddings"],
+                                                           max_records):
+                self.write(**{key: values[start:stop] for key, values in batch.items()})
+                if self.rollback_on_error:
+                    with self._lock:
+                        self._written_ids.extend(batch["ids"][start:stop])
+                if self.manager.lexical_index is not None:
+                    self.manager.lexical_index.add(self.collection.name,
+                                                   batch["ids"][start:stop],
+                                                   batch["documents"][start:stop])
+                self._count("written", stop - start)
+            with self._lock:
+                self.timings["write"] += time.perf_counter() - started
+        self._complete(seq, end)
+
+    def _complete(self, seq: int, end: int):
+        """
+        Отмечает батч записанным. Батчи могут завершаться не по порядку, поэтому
+        контрольная точка - конец самого длинного непрерывного префикса записанных батчей
+        """
+        checkpoint = None
+        with self._lock:
+            self._completed[seq] = end
+            while self._next_seq in self._completed:
+                checkpoint = self._completed.pop(self._next_seq)
+                self._next_seq += 1
+        if checkpoint is not None and self.on_checkpoint:
+            self.on_checkpoint(checkpoint)
+
+    def _fail(self, error: Exception):
+        with self._lock:
+            self._errors.append(error)
+        self._failed.set()
+        # Ошибка видна в прогрессе задачи, а не только в итоговом error
+        self._count("errors", 1)
+
+    def _consume(self, source_queue: queue.Queue, handler: Callable):
+        """Обрабатывает батчи из очереди до маркера конца; после ошибки только вычитывает очередь"""
+        while True:
+            batch = source_queue.get()
+            if batch is _DONE:
+                return
+            if self._failed.is_set():
+                continue
+            try:
+                handler(batch)
+            except Exception as e:
+                self._fail(e)
+
+    def _run_threaded(self):
+        embed_queue = queue.Queue(maxsize=self.queue_size * self.embed_workers)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+
+        def embed_worker():
+            self._consume(embed_queue, lambda batch: write_queue.put(self._embed(batch)))
+
+        embedders = [threading.Thread(target=embed_worker, daemon=True)
+                     for _ in range(self.embed_workers)]
+        writer = threading.Thread(target=self._consume, args=(write_queue, self._write),
+                                  daemon=True)
+        for thread in embedders + [writer]:
+            thread.start()
+
+        try:
+            for batch in self._read_batches():
+                if self._failed.is_set():
+                    break
+                embed_queue.put(batch)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in embedders:
+                embed_queue.put(_DONE)
+            for thread in embedders:
+                thread.join()
+            write_queue.put(_DONE)
+            writer.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+    def _rollback(self):
+        """Удаляет чанки, записанные до ошибки"""
+        ids = self._written_ids
+        try:
+            for i in range(0, len(ids), 1000):
+                self.collection.delete(ids=ids[i:i + 1000])
+            if self.manager.lexical_index is not None:
+                self.manager.lexical_index.delete(self.collection.name, ids)
+            logging.info(f"Ingestion into {self.collection.name} failed, "
+                         f"{len(ids)} written chunks removed")
+        except Exception as e:
+            logging.error(f"Error removing {len(ids)} partially written chunks "
+                          f"from {self.collection.name}: {str(e)}")
+
+    def _run_sequential(self):
+        try:
+            for batch in self._read_batches():
+                self._write(self._embed(batch))
+        except Exception as e:
+            self._fail(e)
+            raise
+
+    def run(self) -> Dict[str, Any]:
+        """Выполняет загрузку и возвращает счетчики и время каждого этапа"""
+        started = time.perf_counter()
+        collection_name = self.collection.name
+
+        if self.incremental:
+            if not self.source:
+                raise ValueError("source is required for incremental upsert")
+            self._existing = self.manager._source_ids(self.collection, self.source)
+
+        try:
+            if self.threaded:
+                self._run_threaded()
+            else:
+                self._run_sequential()
+        except Exception:
+            if self._written_ids:
+                self._rollback()
+            raise
+        finally:
+            # Часть батчей могла быть записана и при ошибке
+            if self.stats["written"]:
+                self.manager.query_cache.invalidate(collection_name)
+
+        if self.incremental:
+            # Удаляем чанки, которых больше нет в новой версии документа
+            delete_started = time.perf_counter()
+            stale = list(self._existing - set(self.ids))
+            for i in range(0, len(stale), 1000):
+                self.collection.delete(ids=stale[i:i + 1000])
+            if stale and self.manager.lexical_index is not None:
+                self.manager.lexical_index.delete(collection_name, stale)
+            if stale:
+                self.manager.query_cache.invalidate(collection_name)
+            self._count("deleted", len(stale), time.perf_counter() - delete_started, "write")
+
+        self.timings["total"] = time.perf_counter() - started
+        logging.info(f"Ingestion into {collection_name}: {self.stats}, "
+                     f"timings: { {k: round(v, 3) for k, v in self.timings.items()} }")
+        return {
+            "stats": dict(self.stats),
+            "timings": {stage: round(seconds, 3) for stage, seconds in self.timings.items()}
+        }
@@ -1,19 +1,553 @@
-from typing import List, Union
+from typing import List, Union, Iterator, Iterable, Callable, BinaryIO, Optional
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 import logging
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import docx
 import PyPDF2
 import io
+import itertools
 import json
+import codecs
 import csv
+import hashlib
+import multiprocessing
+import shutil
 import ssl
 import os
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pdf_pages import MappedFile, map_file, extract_pdf_pages
 
 # Отключаем проверку SSL для тестирования
 ssl._create_default_https_context = ssl._create_unverified_context
 
+# Максимальный размер исходного файла (локального или загружаемого) в MB
+MAX_FILE_SIZE_MB = int(os.getenv('CHROMA_MAX_FILE_SIZE_MB') or 10)
+# Загрузка больше порога (MB) сбрасывается из памяти во временный файл
+DOWNLOAD_SPOOL_MB = int(os.getenv('CHROMA_DOWNLOAD_SPOOL_MB') or 1)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Размер блока потокового декодирования текста
+TEXT_BLOCK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+# Процессы извлечения текста PDF (на каждый worker gunicorn; по умолчанию ядра
+# делятся между 4 воркерами) и порог в страницах, с которого PDF разбирается параллельно
+PDF_WORKERS = int(os.getenv('CHROMA_PDF_WORKERS') or max(1, (os.cpu_count() or 1) // 4))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('CHROMA_PDF_PARALLEL_MIN_PAGES') or 10)
+# Наибольший диапазон страниц на задачу пула: первые страницы готовы раньше остальных
+PDF_RANGE_PAGES = 16
+DOWNLOAD_RETRIES = 3
+# Форматы, которые читает read_file (тип определяется по расширению)
+SUPPORTED_FILE_TYPES = ('txt', 'docx', 'pdf', 'csv', 'json')
+# Разделители RecursiveCharacterTextSplitter по убыванию приоритета
+SPLIT_SEPARATORS = ["\n\n", "\n", ". ", "! ", "? ", ".", "!", "?", " ", ""]
+# split_text при parallel делит текст длиннее порога (символов) по абзацам,
+# а строки с разделителями - группами, если строк больше порога
+PARALLEL_SPLIT_CHARS = 100000
+PARALLEL_SPLIT_LINES = 1000
+# Кэш загрузок по URL с условными запросами (ETag/Last-Modified); пусто - отключен
+DOWNLOAD_CACHE_DIR = os.getenv('CHROMA_DOWNLOAD_CACHE_DIR', '')
+# Предел размера кэша загрузок (MB) и срок хранения неиспользуемой записи (часы);
+# 0 - без предела. Записи вытесняются по давности использования
+DOWNLOAD_CACHE_MAX_MB = int(os.getenv('CHROMA_DOWNLOAD_CACHE_MAX_MB', '1024') or 0)
+DOWNLOAD_CACHE_MAX_AGE_HOURS = int(os.getenv('CHROMA_DOWNLOAD_CACHE_MAX_AGE_HOURS', '168') or 0)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Общая для воркера сессия requests: пул соединений (keep-alive к одним и тем же
+    хостам) и повторы при сетевых ошибках и ответах 429/5xx
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=DOWNLOAD_RETRIES, backoff_factor=0.5,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=('GET', 'HEAD'))
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.verify = False
+            _session = session
+        return _session
+
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    Общий пул процессов для извлечения текста PDF: PyPDF2 - чистый Python,
+    и в потоках извлечение упирается в GIL. Процессы запускаются через spawn,
+    чтобы не наследовать потоки и соединения процесса приложения
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pdf_pool
+
+
+def _reset_pdf_pool(pool: ProcessPoolExecutor):
+    """Сбрасывает сломанный пул (процесс упал), следующий вызов создаст новый"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False)
+
+
+def _stream_body(response: requests.Response, file, url: str):
+    """Пишет тело ответа в файл частями, прерывая загрузку сверх MAX_FILE_SIZE_MB"""
+    max_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise ValueError(f"File too large: {url}")
+    size = 0
+    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise ValueError(f"File too large: {url}")
+        file.write(chunk)
+
+
+def _response_encoding(response: requests.Response) -> Optional[str]:
+    """Кодировка из Content-Type (None, если не указана)"""
+    content_type = response.headers.get('Content-Type', '')
+    if 'charset=' in content_type:
+        return content_type.split('charset=')[-1].split(';')[0].strip().strip('"')
+    return None
+
+
+class DownloadCache:
+    """
+    Дисковый кэш загрузок по URL. Хранит тело файла, ETag/Last-Modified
+    и уже извлеченные чанки. Повторная загрузка - условный GET
+    (If-None-Match / If-Modified-Since): на 304 тело берется с диска,
+    а если чанки для тех же параметров разбиения уже есть - пропускается и разбор.
+    Внутри scope() URL проверяется на сервере не больше одного раза.
+    После записи тела или чанков кэш сжимается до max_bytes и max_age
+    (по времени последнего использования записи)
+    """
+
+    # Временные файлы и жесткие ссылки .link-* старше этого срока (с) считаются
+    # брошенными (воркер упал, не удалив их); запись со свежей ссылкой не вытесняется
+    STALE_SECONDS = 6 * 3600
+
+    def __init__(self, directory: str, max_bytes: int = 0, max_age: float = 0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def _entry_dir(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def _read_meta(self, url: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._entry_dir(url), 'meta.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    @contextmanager
+    def _atomic_file(path: str, mode: str = 'wb'):
+        """
+        Файл, который появляется под path через os.replace только после успешной
+        записи, чтобы другие воркеры не видели его частично; при ошибке или
+        незавершенной записи (генератор закрыт) временный файл удаляется
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+                yield f
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @staticmethod
+    def _write_atomic(path: str, write):
+        with DownloadCache._atomic_file(path) as f:
+            write(f)
+
+    @contextmanager
+    def scope(self):
+        """В пределах scope результат проверки URL переиспользуется без новых запросов"""
+        self._local.checked = {}
+        try:
+            yield
+        finally:
+            self._local.checked = None
+
+    def get(self, url: str) -> dict:
+        """
+        Возвращает {"path", "encoding", "validator", "modified"} для актуального тела URL.
+        modified=False - сервер ответил 304 и тело взято из кэша
+        """
+        checked = getattr(self._local, 'checked', None)
+        if checked is not None and url in checked:
+            return checked[url]
+
+        entry_dir = self._entry_dir(url)
+        body_path = os.path.join(entry_dir, 'body')
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        meta = self._read_meta(url)
+        headers = {}
+        if meta and os.path.exists(body_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with get_session().get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT,
+                               stream=True) as response:
+            if response.status_code == 304 and headers:
+                result = {"path": body_path, "encoding": meta.get('encoding'),
+                          "validator": meta.get('etag') or meta.get('last_modified'),
+                          "modified": False}
+                # Время изменения meta.json - время последнего использования записи
+                try:
+                    os.utime(meta_path)
+                except OSError:
+                    pass
+            else:
+                response.raise_for_status()
+                os.makedirs(entry_dir, exist_ok=True)
+                self._write_atomic(body_path, lambda f: _stream_body(response, f, url))
+                meta = {
+                    "url": url,
+                    "etag": response.headers.get('ETag'),
+                    "last_modified": response.headers.get('Last-Modified'),
+                    "encoding": _response_encoding(response)
+                }
+                self._write_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+                result = {"path": body_path, "encoding": meta['encoding'],
+                          "validator": meta['etag'] or meta['last_modified'],
+                          "modified": True}
+
+        if result["modified"]:
+            self.evict(keep=url)
+        if checked is not None:
+            checked[url] = result
+        return result
+
+    def _chunks_path(self, url: str, validator: str, params: dict) -> str:
+        key = hashlib.sha256(json.dumps([validator, params], sort_keys=True,
+                                        ensure_ascii=False).encode('utf-8')).hexdigest()
+        return os.path.join(self._entry_dir(url), f"chunks-{key}.ndjson")
+
+    def load_chunks(self, url: str, validator: Optional[str],
+                    params: dict) -> Optional[Iterator[str]]:
+        """Сохраненные чанки (по одному на строку NDJSON) или None, если их нет"""
+        if not validator:
+            return None
+        try:
+            f = open(self._chunks_path(url, validator, params), 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+
+        def read():
+            with f:
+                for line in f:
+                    yield json.loads(line)
+        return read()
+
+    @contextmanager
+    def chunk_writer(self, url: str, validator: Optional[str], params: dict):
+        """
+        Функция записи чанков в кэш по одному, без списка в памяти. Файл чанков
+        появляется только после выхода из блока без ошибок; чанки прежних версий
+        файла при этом удаляются. Без validator чанки не сохраняются
+        """
+        if not validator:
+            yield lambda chunk: None
+            return
+        path = self._chunks_path(url, validator, params)
+        entry_dir = os.path.dirname(path)
+        os.makedirs(entry_dir, exist_ok=True)
+        with self._atomic_file(path, 'w') as f:
+            yield lambda chunk: f.write(json.dumps(chunk, ensure_ascii=False) + '\n')
+            for name in os.listdir(entry_dir):
+                if name.startswith('chunks-') and name != os.path.basename(path):
+                    try:
+                        os.remove(os.path.join(entry_dir, name))
+                    except OSError:
+                        pass
+        self.evict(keep=url)
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Удаляет брошенные временные файлы и ссылки, записи старше max_age
+        и самые давно использованные записи сверх max_bytes. Запись keep и записи,
+        тело которых сейчас разбирается (есть свежая ссылка .link-*), не удаляются
+        """
+        now = time.time()
+        keep_dir = os.path.basename(self._entry_dir(keep)) if keep else None
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            entry_dir = os.path.join(self.directory, name)
+            size, in_use = self._sweep_entry(entry_dir, now)
+            if size is None:
+                continue
+            try:
+                used = os.stat(os.path.join(entry_dir, 'meta.json')).st_mtime
+            except OSError:
+                # Запись без meta.json только создается (или уже удаляется)
+                try:
+                    used = os.stat(entry_dir).st_mtime
+                except OSError:
+                    continue
+            total += size
+            if name != keep_dir and not in_use:
+                entries.append((used, size, entry_dir))
+
+        for used, size, entry_dir in sorted(entries):
+            expired = self.max_age and now - used > self.max_age
+            if not expired and not (self.max_bytes and total > self.max_bytes):
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def _sweep_entry(self, entry_dir: str, now: float) -> tuple:
+        """
+        Удаляет из записи брошенные .tmp-* и .link-*; возвращает (размер записи
+        в байтах без учета ссылок на тот же inode, есть ли свежая ссылка)
+        """
+        try:
+            names = os.listdir(entry_dir)
+        except OSError:
+            return None, False
+        size = 0
+        inodes = set()
+        in_use = False
+        for name in names:
+            path = os.path.join(entry_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith('.link-') or name.startswith('.tmp-'):
+                # ctime ссылки меняется при создании и удалении других ссылок на inode,
+                # mtime временного файла - при записи
+                changed = max(stat.st_ctime, stat.st_mtime)
+                if now - changed > self.STALE_SECONDS:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                in_use = True
+            if (stat.st_dev, stat.st_ino) not in inodes:
+                inodes.add((stat.st_dev, stat.st_ino))
+                size += stat.st_size
+        return size, in_use
+
+
+download_cache = DownloadCache(
+    DOWNLOAD_CACHE_DIR,
+    max_bytes=DOWNLOAD_CACHE_MAX_MB * 1024 * 1024,
+    max_age=DOWNLOAD_CACHE_MAX_AGE_HOURS * 3600
+) if DOWNLOAD_CACHE_DIR else None
+
+
+class _MergedChunks:
+    """
+    Склейка частей в чанки как _merge_splits у RecursiveCharacterTextSplitter,
+    но по одной части: готовый чанк сразу уходит в out
+    """
+
+    def __init__(self, separator: str, chunk_size: int, chunk_overlap: int, out: List[str]):
+        self.separator = separator
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.out = out
+        self._current = []
+        self._total = 0
+
+    def _emit(self):
+        text = self.separator.join(self._current).strip()
+        if text:
+            self.out.append(text)
+
+    def add(self, split: str):
+        separator_len = len(self.separator)
+        length = len(split)
+        if self._total + length + (separator_len if self._current else 0) > self.chunk_size:
+            if self._current:
+                self._emit()
+                # Перекрытие: в начале следующего чанка остаются последние части
+                while self._total > self.chunk_overlap or (
+                        self._total + length + (separator_len if self._current else 0)
+                        > self.chunk_size and self._total > 0):
+                    self._total -= len(self._current[0]) + (
+                        separator_len if len(self._current) > 1 else 0)
+                    self._current.pop(0)
+        self._current.append(split)
+        self._total += length + (separator_len if len(self._current) > 1 else 0)
+
+    def flush(self):
+        self._emit()
+        self._current = []
+        self._total = 0
+
+
+class _StreamingSplitter:
+    """
+    Потоковый RecursiveCharacterTextSplitter (keep_separator=False, длина - len):
+    feed() принимает текст частями, а в out попадают те же чанки, что дал бы
+    split_text над всем текстом. Текст делится первым по приоритету из встреченных
+    разделителей; если позже встречается более приоритетный, весь текст до него -
+    первая часть нового уровня: короткий (короче chunk_size, чанков еще не было)
+    склеивается с остальными частями, длинный уже разобран так же, как его
+    разобрал бы split_text рекурсивно - более приоритетных разделителей в нем нет.
+    В памяти - хвост текущего чанка на каждый уровень разделителей, а не весь текст
+    """
+
+    def __init__(self, separators: List[str], chunk_size: int, chunk_overlap: int,
+                 out: Optional[List[str]] = None):
+        self.separators = separators
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.out = out if out is not None else []
+        # Конец буфера может оказаться началом разделителя из следующей части
+        self._hold = max(len(sep) for sep in separators) - 1
+        # До первого разделителя текст делится посимвольно (последний разделитель - "")
+        self._level = len(separators) - 1
+        self._merged = _MergedChunks(separators[self._level], chunk_size, chunk_overlap, self.out)
+        self._open = ''
+        self._child = None
+        self._buffer = ''
+        # Длина текста уровня и сам текст, пока он короче chunk_size
+        self._consumed = 0
+        self._head = []
+        self._next = {}
+
+    def drain(self) -> List[str]:
+        chunks = self.out[:]
+        self.out.clear()
+        return chunks
+
+    def feed(self, text: str):
+        self._buffer += text
+        self._scan(final=False)
+
+    def finish(self):
+        self._scan(final=True)
+        self._close_split()
+        self._merged.flush()
+
+    def _scan(self, final: bool):
+        buffer = self._buffer
+        limit = len(buffer) if final else len(buffer) - self._hold
+        position = 0
+        self._next = {}
+        while True:
+            # Ближайший разделитель текущего уровня или более приоритетный;
+            # при совпадении позиций - более приоритетный
+            found = None
+            for index in range(self._level + 1):
+                separator = self.separators[index]
+                if not separator:
+                    continue
+                at = self._next.get(index)
+                if at is None or (at != -1 and at < position):
+                    at = buffer.find(separator, position)
+                    self._next[index] = at
+                if at != -1 and (found is None or at < found[0]):
+                    found = (at, index)
+            if found is None or found[0] >= limit:
+                break
+            at, index = found
+            self._append(buffer[position:at])
+            if index < self._level:
+                self._upgrade(index)
+            else:
+                self._close_split()
+            separator = self.separators[index]
+            self._count(separator)
+            position = at + len(separator)
+        if position < limit:
+            self._append(buffer[position:limit])
+            position = limit
+        self._buffer = buffer[position:]
+
+    def _count(self, text: str):
+        if self._consumed < self.chunk_size:
+            self._head.append(text)
+        self._consumed += len(text)
+
+    def _append(self, text: str):
+        """Текст текущей части (между разделителями уровня)"""
+        if not text:
+            return
+        self._count(text)
+        if not self.separators[self._level]:
+            for char in text:
+                if len(char) < self.chunk_size:
+                    self._merged.add(char)
+                else:
+                    self._merged.flush()
+                    self.out.append(char)
+            return
+        if self._child is not None:
+            self._child.feed(text)
+            return
+        self._open += text
+        if len(self._open) >= self.chunk_size:
+            # Длинная часть делится следующими разделителями
+            self._merged.flush()
+            self._child = _StreamingSplitter(self.separators[self._level + 1:], self.chunk_size,
+                                             self.chunk_overlap, self.out)
+            self._child.feed(self._open)
+            self._open = ''
+
+    def _close_split(self):
+        if self._child is not None:
+            self._child.finish()
+            self._child = None
+        elif self._open:
+            self._merged.add(self._open)
+            self._open = ''
+
+    def _upgrade(self, index: int):
+        """Встречен более приоритетный разделитель: весь текст до него - первая часть"""
+        merged = _MergedChunks(self.separators[index], self.chunk_size, self.chunk_overlap,
+                               self.out)
+        if self._consumed < self.chunk_size:
+            head = ''.join(self._head)
+            self._open = ''
+            if head:
+                merged.add(head)
+        else:
+            self._close_split()
+            self._merged.flush()
+        self._merged = merged
+        self._level = index
+
+
 class DocumentReader:
     @staticmethod
     def is_url(path: str) -> bool:
@@ -41,7 +575,7 @@ class DocumentReader:
         return any(abs_path.startswith(allowed_dir) for allowed_dir in allowed_dirs)
 
     @staticmethod
-    def check_file_size(path: str, max_size_mb: int = 10) -> bool:
+    def check_file_size(path: str, max_size_mb: int = MAX_FILE_SIZE_MB) -> bool:
         """
         Проверяет размер файла
         """
@@ -49,32 +583,109 @@ class DocumentReader:
         return os.path.getsize(path) <= max_size_bytes
 
     @staticmethod
-    def download_file(path: str) -> str:
+    def check_local_path(path: str):
+        """Проверяет, что локальный файл разрешен, существует и не превышает лимит"""
+        # Проверяем безопасность пути
+        if not DocumentReader.is_safe_path(path):
+            raise ValueError(f"Access to path not allowed: {path}")
+
+        # Проверяем существование файла
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File not found: {path}")
+
+        # Проверяем размер файла
+        if not DocumentReader.check_file_size(path):
+            raise ValueError(f"File too large: {path}")
+
+    @staticmethod
+    def fetch(url: str) -> tuple:
         """
-        Загружает файл по URL или читает локальный файл
+        Потоково загружает URL через общую сессию с ограничением размера.
+        С кэшем загрузок тело берется из кэша (после условного запроса),
+        иначе пишется в SpooledTemporaryFile: небольшие файлы остаются в памяти,
+        большие сбрасываются на диск. Возвращает (файл в начале, кодировка из
+        Content-Type или None)
         """
-        try:
-            if DocumentReader.is_url(path):
-                # Если это URL, загружаем через requests
-                response = requests.get(path, verify=False, timeout=30)
-                response.raise_for_status()
-                return response.text
-            else:
-                # Проверяем безопасность пути
-                if not DocumentReader.is_safe_path(path):
-                    raise ValueError(f"Access to path not allowed: {path}")
+        if download_cache is not None:
+            cached = download_cache.get(url)
+            return open(cached["path"], 'rb'), cached["encoding"]
+
+        with get_session().get(url, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MB * 1024 * 1024)
+            try:
+                _stream_body(response, spool, url)
+            except Exception:
+                spool.close()
+                raise
+            spool.seek(0)
+            return spool, _response_encoding(response)
+
+    @staticmethod
+    def _open_source(path: str) -> tuple:
+        """
+        Открывает источник: (файл, кодировка из Content-Type или None).
+        Файлы на диске (локальные и из кэша загрузок) отображаются через mmap,
+        загрузки во временный SpooledTemporaryFile отдаются как есть
+        """
+        if DocumentReader.is_url(path):
+            file, encoding = DocumentReader.fetch(path)
+        else:
+            DocumentReader.check_local_path(path)
+            file, encoding = open(path, 'rb'), None
+        if isinstance(file, tempfile.SpooledTemporaryFile):
+            return file, encoding
+        return map_file(file), encoding
 
-                # Проверяем существование файла
-                if not os.path.exists(path):
-                    raise FileNotFoundError(f"File not found: {path}")
+    @staticmethod
+    @contextmanager
+    def open_binary(path: str) -> Iterator[BinaryIO]:
+        """
+        Открывает источник как бинарный файл: URL загружается потоково во временный
+        файл, локальный файл открывается после проверок пути и размера через mmap
+        """
+        file, _ = DocumentReader._open_source(path)
+        with file:
+            yield file
 
-                # Проверяем размер файла
-                if not DocumentReader.check_file_size(path):
-                    raise ValueError(f"File too large: {path}")
+    @staticmethod
+    def iter_text(path: str, encoding: Optional[str] = None,
+                  errors: str = 'strict') -> Iterator[str]:
+        """
+        Потоково декодирует текстовый файл блоками по TEXT_BLOCK_SIZE.
+        Инкрементальный декодер корректно обрабатывает многобайтные символы
+        на границах блоков
+        """
+        file, detected = DocumentReader._open_source(path)
+        decoder = codecs.getincrementaldecoder(encoding or detected or 'utf-8')(errors=errors)
+        with file:
+            while True:
+                block = file.read(TEXT_BLOCK_SIZE)
+                if not block:
+                    break
+                text = decoder.decode(block)
+                if text:
+                    yield text
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
 
-                # Читаем файл
-                with open(path, 'r', encoding='utf-8') as file:
-                    return file.read()
+    @staticmethod
+    def download_file(path: str) -> str:
+        """
+        Загружает файл по URL или читает локальный файл.
+        Локальный файл декодируется прямо из mmap, без промежуточной копии в bytes
+        """
+        try:
+            file, encoding = DocumentReader._open_source(path)
+            # Для URL кодировка из заголовков, битые байты заменяются;
+            # локальные файлы - строго UTF-8, как и раньше
+            errors = 'replace' if DocumentReader.is_url(path) else 'strict'
+            with file:
+                if isinstance(file, MappedFile):
+                    with file.getbuffer() as view:
+                        return str(view, encoding or 'utf-8', errors)
+                return file.read().decode(encoding or 'utf-8', errors)
 
         except Exception as e:
             logging.error(f"Error reading file: {str(e)}")
@@ -87,33 +698,25 @@ class DocumentReader:
         Загружает бинарный файл по URL или читает локальный файл
         """
         try:
-            if DocumentReader.is_url(path):
-                # Если это URL, загружаем через requests
-                response = requests.get(path, verify=False, timeout=30)
-                response.raise_for_status()
-                return response.content
-            else:
-                # Проверяем безопасность пути
-                if not DocumentReader.is_safe_path(path):
-                    raise ValueError(f"Access to path not allowed: {path}")
-
-                # Проверяем существование файла
-                if not os.path.exists(path):
-                    raise FileNotFoundError(f"File not found: {path}")
-
-                # Проверяем размер файла
-                if not DocumentReader.check_file_size(path):
-                    raise ValueError(f"File too large: {path}")
-
-                # Читаем файл
-                with open(path, 'rb') as file:
-                    return file.read()
+            with DocumentReader.open_binary(path) as file:
+                return file.read()
 
         except Exception as e:
             logging.error(f"Error reading binary file: {str(e)}")
             logging.error(f"Path: {path}")
             raise
 
+    @staticmethod
+    def _text_splitter(chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+        # Используем RecursiveCharacterTextSplitter с оптимизированными параметрами
+        return RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            separators=SPLIT_SEPARATORS,
+            keep_separator=False
+        )
+
     @staticmethod
     def split_text(text: str, chunk_size: int = None, chunk_overlap: int = None,
                    custom_separators: List[str] = None,
@@ -148,10 +751,19 @@ class DocumentReader:
 
                 return local_chunks
 
-            if parallel and len(lines) > 1000:  # Порог для параллельной обработки
-                # Разбиваем строки на части для параллельной обработки
+            if parallel and len(lines) > PARALLEL_SPLIT_LINES:  # Порог для параллельной обработки
+                # Разбиваем строки на части для параллельной обработки; часть начинается
+                # со строки-разделителя, чтобы чанк не разрезался границей частей
                 lines_per_worker = len(lines) // max_workers
-                line_chunks = [lines[i:i + lines_per_worker] for i in range(0, len(lines), lines_per_worker)]
+                bounds = [0]
+                for target in range(lines_per_worker, len(lines), lines_per_worker):
+                    start = max(target, bounds[-1] + 1)
+                    while start < len(lines) and not any(sep in lines[start] for sep in custom_separators):
+                        start += 1
+                    if start < len(lines):
+                        bounds.append(start)
+                bounds.append(len(lines))
+                line_chunks = [lines[a:b] for a, b in zip(bounds, bounds[1:]) if b > a]
 
                 with ThreadPoolExecutor(max_workers=max_workers) as executor:
                     chunk_results = executor.map(process_lines, line_chunks)
@@ -166,17 +778,10 @@ class DocumentReader:
         elif chunk_size:
             chunk_overlap = chunk_overlap or 0
 
-            # Используем RecursiveCharacterTextSplitter с оптимизированными параметрами
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-                length_function=len,
-                separators=["\n\n", "\n", ". ", "! ", "? ", ".", "!", "?", " ", ""],
-                keep_separator=False
-            )
+            text_splitter = DocumentReader._text_splitter(chunk_size, chunk_overlap)
 
             # Если текст большой, разбиваем его на части для параллельной обработки
-            if parallel and len(text) > 100000:  # Порог для параллельной обработки
+            if parallel and len(text) > PARALLEL_SPLIT_CHARS:  # Порог для параллельной обработки
                 # Примерно разбиваем текст на части по параграфам
                 paragraphs = text.split('\n\n')
                 chunks = []
@@ -198,6 +803,118 @@ class DocumentReader:
 
         return [text]
 
+    @staticmethod
+    def split_stream(pieces: Iterable[str], chunk_size: int = None, chunk_overlap: int = None,
+                     custom_separators: List[str] = None, **kwargs) -> Iterator[str]:
+        """
+        Потоковый вариант split_text: принимает текст частями (страницы, блоки),
+        которые склеиваются как есть, и отдает чанки, как только они готовы.
+        Чанки те же, что у split_text над склеенным текстом с теми же parallel
+        и max_workers: границы частей на разбиение не влияют
+        """
+        parallel = kwargs.get('parallel', True)
+        if custom_separators:
+            yield from DocumentReader._split_stream_by_separators(
+                pieces, chunk_size, chunk_overlap, custom_separators,
+                parallel=parallel, max_workers=kwargs.get('max_workers', 4))
+        elif chunk_size:
+            yield from DocumentReader._split_stream_by_size(pieces, chunk_size, chunk_overlap or 0,
+                                                            parallel=parallel)
+        else:
+            yield from DocumentReader.split_text(''.join(pieces))
+
+    @staticmethod
+    def _split_stream_by_separators(pieces: Iterable[str], chunk_size: Optional[int],
+                                    chunk_overlap: Optional[int],
+                                    custom_separators: List[str],
+                                    parallel: bool = True,
+                                    max_workers: int = 4) -> Iterator[str]:
+        """Чанки между строками-разделителями, как в split_text"""
+        current = []
+        found = False
+        pending = ''
+
+        def process_line(line):
+            nonlocal current, found
+            if any(sep in line for sep in custom_separators):
+                found = True
+                chunk = '\n'.join(current).strip()
+                current = []
+                return chunk
+            current.append(line)
+            return None
+
+        for piece in pieces:
+            # Неполная последняя строка части ждет продолжения в следующей
+            lines = (pending + piece).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                chunk = process_line(line)
+                if chunk:
+                    yield chunk
+        chunk = process_line(pending)
+        if chunk:
+            yield chunk
+
+        if not found:
+            # До первого разделителя чанки не отдаются, поэтому current - весь текст;
+            # разделителей нет - делим по размеру, как split_text
+            yield from DocumentReader.split_text('\n'.join(current), chunk_size, chunk_overlap,
+                                                 parallel=parallel, max_workers=max_workers)
+            return
+        chunk = '\n'.join(current).strip()
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _split_stream_by_size(pieces: Iterable[str], chunk_size: int, chunk_overlap: int,
+                              parallel: bool = True) -> Iterator[str]:
+        """
+        Чанки по размеру, как в split_text: текст до PARALLEL_SPLIT_CHARS делится
+        целиком, более длинный (при parallel) - по абзацам, каждый абзац отдельно.
+        Длинный текст и абзацы делятся потоково (_StreamingSplitter)
+        """
+        iterator = iter(pieces)
+        if parallel:
+            # Пока текст не длиннее порога, его режим разбиения неизвестен
+            head = []
+            size = 0
+            for piece in iterator:
+                head.append(piece)
+                size += len(piece)
+                if size > PARALLEL_SPLIT_CHARS:
+                    break
+            else:
+                yield from DocumentReader._text_splitter(chunk_size, chunk_overlap).split_text(
+                    ''.join(head))
+                return
+            iterator = itertools.chain(head, iterator)
+
+        splitter = _StreamingSplitter(SPLIT_SEPARATORS, chunk_size, chunk_overlap)
+        pending = ''
+        for piece in iterator:
+            if not parallel:
+                splitter.feed(piece)
+                yield from splitter.drain()
+                continue
+            # Абзацы - text.split('\n\n'); последний '\n' может начать разделитель
+            # вместе со следующей частью
+            pending += piece
+            paragraphs = pending.split('\n\n')
+            pending = paragraphs.pop()
+            for paragraph in paragraphs:
+                splitter.feed(paragraph)
+                splitter.finish()
+                yield from splitter.drain()
+                splitter = _StreamingSplitter(SPLIT_SEPARATORS, chunk_size, chunk_overlap)
+            keep = 1 if pending.endswith('\n') else 0
+            splitter.feed(pending[:len(pending) - keep])
+            pending = pending[len(pending) - keep:]
+            yield from splitter.drain()
+        splitter.feed(pending)
+        splitter.finish()
+        yield from splitter.drain()
+
     @staticmethod
     def read_txt(path: str, **kwargs) -> str:
         """
@@ -211,8 +928,8 @@ class DocumentReader:
         Читает файл DOCX
         """
         try:
-            content = DocumentReader.download_binary(path)
-            doc = docx.Document(io.BytesIO(content))
+            with DocumentReader.open_binary(path) as file:
+                doc = docx.Document(file)
 
             # Параллельное извлечение текста из параграфов
             def process_paragraphs(paragraphs):
@@ -239,30 +956,101 @@ class DocumentReader:
             raise
 
     @staticmethod
-    def read_pdf(path: str, **kwargs) -> str:
+    def _link_open_file(file) -> Optional[str]:
         """
-        Читает файл PDF
+        Жесткая ссылка на ту версию файла, что уже открыта: если путь успели
+        заменить (ссылка ведет на другой inode) или ФС не поддерживает ссылки - None
         """
+        link = os.path.join(os.path.dirname(file.name), f".link-{os.urandom(8).hex()}")
         try:
-            content = DocumentReader.download_binary(path)
-            pdf_file = io.BytesIO(content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
+            os.link(file.name, link)
+        except OSError:
+            return None
+        if not os.path.samestat(os.stat(link), os.fstat(file.fileno())):
+            os.remove(link)
+            return None
+        return link
 
-            def extract_page_text(page):
-                return page.extract_text()
+    @staticmethod
+    @contextmanager
+    def local_copy(path: str) -> Iterator[str]:
+        """
+        Путь к источнику на диске, который могут открыть другие процессы:
+        локальный файл как есть, тело из кэша загрузок - через собственную жесткую
+        ссылку (другой воркер может заменить тело новой версией через os.replace),
+        загрузка во SpooledTemporaryFile - через временный файл; ссылка и временный
+        файл удаляются после использования
+        """
+        if not DocumentReader.is_url(path):
+            DocumentReader.check_local_path(path)
+            yield path
+            return
 
-            if kwargs.get('parallel', True) and len(pdf_reader.pages) > 10:
-                max_workers = kwargs.get('max_workers', 4)
+        file, _ = DocumentReader.fetch(path)
+        with file:
+            if not isinstance(file, tempfile.SpooledTemporaryFile):
+                link = DocumentReader._link_open_file(file)
+                if link is not None:
+                    try:
+                        yield link
+                    finally:
+                        os.remove(link)
+                    return
+            temp = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+            try:
+                with temp:
+                    shutil.copyfileobj(file, temp, DOWNLOAD_CHUNK_SIZE)
+                file.close()
+                yield temp.name
+            finally:
+                os.remove(temp.name)
 
-                with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    text_chunks = executor.map(extract_page_text, pdf_reader.pages)
+    @staticmethod
+    def iter_pdf_pages(path: str, **kwargs) -> Iterator[str]:
+        """
+        Потоково отдает текст страниц PDF в порядке страниц. Большие файлы делятся
+        на диапазоны страниц, которые извлекаются в пуле процессов; страницы
+        первых диапазонов отдаются, пока остальные еще разбираются
+        """
+        with DocumentReader.local_copy(path) as pdf_path:
+            # PdfReader читает страницы лениво, поэтому файл открыт до конца извлечения;
+            # файл отображен через mmap и не копируется в память
+            with map_file(open(pdf_path, 'rb')) as pdf_file:
+                pdf_reader = PyPDF2.PdfReader(pdf_file)
+                page_count = len(pdf_reader.pages)
+                workers = min(kwargs.get('max_workers') or PDF_WORKERS, PDF_WORKERS)
 
-                return '\n'.join(text_chunks)
-            else:
-                text = []
-                for page in pdf_reader.pages:
-                    text.append(extract_page_text(page))
-                return '\n'.join(text)
+                if not (kwargs.get('parallel', True) and workers > 1
+                        and page_count >= PDF_PARALLEL_MIN_PAGES):
+                    for page in pdf_reader.pages:
+                        yield page.extract_text()
+                    return
+
+            # Каждый процесс разбирает структуру PDF заново, поэтому диапазонов
+            # не больше, чем нужно для загрузки всех процессов и раннего начала отдачи
+            step = min(-(-page_count // workers), PDF_RANGE_PAGES)
+            pool = get_pdf_pool()
+            futures = [pool.submit(extract_pdf_pages, pdf_path, start,
+                                   min(start + step, page_count))
+                       for start in range(0, page_count, step)]
+            try:
+                for future in futures:
+                    yield from future.result()
+            except BrokenProcessPool:
+                _reset_pdf_pool(pool)
+                raise
+            finally:
+                # Потребитель остановился раньше - оставшиеся диапазоны не нужны
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def read_pdf(path: str, **kwargs) -> str:
+        """
+        Читает файл PDF
+        """
+        try:
+            return '\n'.join(DocumentReader.iter_pdf_pages(path, **kwargs))
 
         except Exception as e:
             logging.error(f"Error reading PDF file: {str(e)}")
@@ -300,6 +1088,32 @@ class DocumentReader:
             logging.error(f"Error reading CSV file: {str(e)}")
             raise
 
+    @staticmethod
+    def iter_csv(path: str, **kwargs) -> Iterator[str]:
+        """
+        Потоково читает CSV: каждая строка форматируется и отдается по одной.
+        Файл читается построчно, без загрузки целиком в память
+        """
+        def process_row(row):
+            # Форматируем каждую строку как текст с заголовками
+            return '\n'.join(f"{header}: {value}" for header, value in row.items())
+
+        if DocumentReader.is_url(path):
+            # Загрузка идет во временный файл, строки читаются из него потоково
+            spool, encoding = DocumentReader.fetch(path)
+            with spool, io.TextIOWrapper(spool, encoding=encoding or 'utf-8',
+                                         errors='replace', newline='') as file:
+                for row in csv.DictReader(file):
+                    yield process_row(row)
+            return
+
+        # Те же проверки, что и в download_file
+        DocumentReader.check_local_path(path)
+
+        with open(path, 'r', encoding='utf-8', newline='') as file:
+            for row in csv.DictReader(file):
+                yield process_row(row)
+
     @staticmethod
     def read_json(path: str, **kwargs) -> str:
         """
@@ -314,6 +1128,67 @@ class DocumentReader:
             logging.error(f"Error reading JSON file: {str(e)}")
             raise
 
+    @staticmethod
+    def _read_chunks(reader, path: str, **kwargs) -> List[str]:
+        """Читает файл указанным ридером и разделяет текст на чанки"""
+        # Читаем содержимое файла
+        content = reader(path, **kwargs)
+
+        # Если это список (например, для CSV), возвращаем как есть
+        if isinstance(content, list):
+            return content
+
+        # Разделяем на чанки, если нужно
+        return DocumentReader.split_text(
+            content,
+            chunk_size=kwargs.get('chunk_size'),
+            chunk_overlap=kwargs.get('chunk_overlap'),
+            custom_separators=kwargs.get('custom_separators'),
+            parallel=kwargs.get('parallel', True),
+            max_workers=kwargs.get('max_workers', 4)
+        )
+
+    @staticmethod
+    def _cached_chunks(path: str, kwargs: dict,
+                       read_chunks: Callable[[], Iterable[str]]) -> Iterator[str]:
+        """
+        Чанки URL через кэш загрузок: неизмененный файл (304) с теми же параметрами
+        разбиения не разбирается заново, иначе чанки читаются и сохраняются в кэш
+        """
+        params = {key: kwargs.get(key) for key in
+                  ('chunk_size', 'chunk_overlap', 'custom_separators')}
+        with download_cache.scope():
+            cached = download_cache.get(path)
+            if not cached["modified"]:
+                chunks = download_cache.load_chunks(path, cached["validator"], params)
+                if chunks is not None:
+                    logging.info(f"Not modified, using cached chunks: {path}")
+                    yield from chunks
+                    return
+            # Чанки пишутся в кэш по мере разбора; если чтение прервано,
+            # недописанный файл не сохраняется
+            with download_cache.chunk_writer(path, cached["validator"], params) as write:
+                for chunk in read_chunks():
+                    write(chunk)
+                    yield chunk
+
+    @staticmethod
+    def _iter_pieces(path: str, file_type: str, **kwargs) -> Iterator[str]:
+        """Текст PDF (по страницам) или TXT (блоками) частями для split_stream"""
+        if file_type == 'pdf':
+            # Страницы склеиваются через перевод строки, как в read_pdf
+            for number, page in enumerate(DocumentReader.iter_pdf_pages(path, **kwargs)):
+                yield '\n' + page if number else page
+        else:
+            # Для URL битые байты заменяются, локальные файлы - строго UTF-8, как в download_file
+            yield from DocumentReader.iter_text(
+                path, errors='replace' if DocumentReader.is_url(path) else 'strict')
+
+    @staticmethod
+    def is_supported(path: str) -> bool:
+        """Проверяет, что формат файла (по расширению) поддерживается read_file"""
+        return path.split('.')[-1].lower() in SUPPORTED_FILE_TYPES
+
     @staticmethod
     def read_file(path: str, **kwargs) -> Union[str, List[str]]:
         """
@@ -336,25 +1211,50 @@ class DocumentReader:
             if file_type not in readers:
                 raise ValueError(f"Unsupported file type: {file_type}")
 
-            # Читаем содержимое файла
-            content = readers[file_type](path, **kwargs)
-
-            # Если это список (например, для CSV), возвращаем как есть
-            if isinstance(content, list):
-                return content
-
-            # Разделяем на чанки, если нужно
-            return DocumentReader.split_text(
-                content,
-                chunk_size=kwargs.get('chunk_size'),
-                chunk_overlap=kwargs.get('chunk_overlap'),
-                custom_separators=kwargs.get('custom_separators'),
-                parallel=kwargs.get('parallel', True),
-                max_workers=kwargs.get('max_workers', 4)
-            )
+            if DocumentReader.is_url(path) and download_cache is not None:
+                return list(DocumentReader._cached_chunks(
+                    path, kwargs,
+                    lambda: DocumentReader._read_chunks(readers[file_type], path, **kwargs)))
+
+            return DocumentReader._read_chunks(readers[file_type], path, **kwargs)
 
         except Exception as e:
             logging.error(f"Error in read_file: {str(e)}")
             logging.error(f"Path: {path}")
             logging.error(f"kwargs: {kwargs}")
-            raise
\ No newline at end of file
+            raise
+
+    @staticmethod
+    def iter_chunks(path: str, **kwargs) -> Iterator[str]:
+        """
+        Потоково отдает чанки файла для конвейера загрузки.
+        CSV читается построчно, PDF и TXT разбиваются на чанки по мере извлечения
+        страниц (блоков), остальные форматы - через read_file
+        """
+        try:
+            file_type = path.split('.')[-1].lower()
+            if file_type == 'csv':
+                yield from DocumentReader.iter_csv(path, **kwargs)
+                return
+
+            if file_type in ('pdf', 'txt'):
+                def read_chunks():
+                    return DocumentReader.split_stream(
+                        DocumentReader._iter_pieces(path, file_type, **kwargs), **kwargs)
+
+                if DocumentReader.is_url(path) and download_cache is not None:
+                    yield from DocumentReader._cached_chunks(path, kwargs, read_chunks)
+                else:
+                    yield from read_chunks()
+                return
+
+            content = DocumentReader.read_file(path, **kwargs)
+            # Убеждаемся, что content - это список
+            if not isinstance(content, list):
+                content = [content]
+            yield from content
+
+        except Exception as e:
+            logging.error(f"Error in iter_chunks: {str(e)}")
+            logging.error(f"Path: {path}")
+            raise
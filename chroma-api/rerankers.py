@@ -0,0 +1,195 @@
+from typing import List, Dict, Optional
+from collections import Counter
+import abc
+import logging
+import math
+import os
+import threading
+import numpy as np
+from lexical import query_tokens
+
+try:
+    import onnxruntime
+    from tokenizers import Tokenizer
+except ImportError:  # ONNX модель - необязательный скорер
+    onnxruntime = None
+    Tokenizer = None
+
+
+# Вес косинусной близости в гибридном скорере (остальное - лексическая оценка)
+RERANK_COSINE_WEIGHT = float(os.getenv('CHROMA_RERANK_COSINE_WEIGHT') or 0.5)
+# Каталог с локальной ONNX моделью cross-encoder (model.onnx и tokenizer.json)
+RERANK_ONNX_MODEL = os.getenv('CHROMA_RERANK_ONNX_MODEL', '')
+RERANK_ONNX_MAX_LENGTH = int(os.getenv('CHROMA_RERANK_ONNX_MAX_LENGTH') or 512)
+
+
+class Reranker(abc.ABC):
+    """
+    Скорер для переранжирования кандидатов поиска.
+    score получает запрос, тексты кандидатов и косинусные расстояния из Chroma
+    (None для кандидатов без расстояния) и возвращает оценки: больше - лучше
+    """
+    name = None
+
+    @abc.abstractmethod
+    def score(self, query: str, documents: List[str],
+              distances: List[Optional[float]]) -> List[float]:
+        pass
+
+
+class LexicalReranker(Reranker):
+    """BM25 по набору кандидатов: быстрый CPU скорер без модели"""
+    name = 'lexical'
+    k1 = 1.2
+    b = 0.75
+
+    def score(self, query, documents, distances):
+        tokens = set(query_tokens(query))
+        if not tokens or not documents:
+            return [0.0] * len(documents)
+        counts = [Counter(query_tokens(document or '')) for document in documents]
+        lengths = [sum(count.values()) for count in counts]
+        average_length = (sum(lengths) / len(lengths)) or 1.0
+        scores = []
+        for count, length in zip(counts, lengths):
+            score = 0.0
+            for token in tokens:
+                frequency = count.get(token, 0)
+                if not frequency:
+                    continue
+                df = sum(1 for other in counts if token in other)
+                idf = math.log(1 + (len(counts) - df + 0.5) / (df + 0.5))
+                score += idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+            scores.append(score)
+        return scores
+
+
+class CosineLexicalReranker(Reranker):
+    """
+    Взвешенная сумма косинусной близости (1 - расстояние; коллекции создаются
+    с hnsw:space=cosine) и нормированной BM25 оценки
+    """
+    name = 'cosine_lexical'
+
+    def __init__(self, cosine_weight: float = RERANK_COSINE_WEIGHT):
+        self.cosine_weight = cosine_weight
+        self.lexical = LexicalReranker()
+
+    def score(self, query, documents, distances):
+        lexical = np.asarray(self.lexical.score(query, documents, distances), dtype=np.float32)
+        if lexical.size and lexical.max() > 0:
+            lexical /= lexical.max()
+        cosine = np.asarray([1.0 - distance if distance is not None else 0.0
+                             for distance in distances], dtype=np.float32)
+        return (self.cosine_weight * cosine + (1 - self.cosine_weight) * lexical).tolist()
+
+
+class OnnxCrossEncoderReranker(Reranker):
+    """
+    Локальная модель cross-encoder в формате ONNX (например, экспорт
+    ms-marco-MiniLM или bge-reranker) на CPU через onnxruntime.
+    Модель загружается при первом использовании
+    """
+    name = 'onnx'
+
+    def __init__(self, model_dir: str = RERANK_ONNX_MODEL,
+                 max_length: int = RERANK_ONNX_MAX_LENGTH):
+        self.model_dir = model_dir
+        self.max_length = max_length
+        self._session = None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._session is not None:
+                return
+            if onnxruntime is None:
+                raise RuntimeError("onnxruntime is not installed")
+            if not self.model_dir:
+                raise RuntimeError("CHROMA_RERANK_ONNX_MODEL is not set")
+            tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, 'tokenizer.json'))
+            tokenizer.enable_truncation(self.max_length)
+            tokenizer.enable_padding()
+            self._tokenizer = tokenizer
+            self._session = onnxruntime.InferenceSession(
+                os.path.join(self.model_dir, 'model.onnx'),
+                providers=['CPUExecutionProvider']
+            )
+            logging.info(f"ONNX reranker loaded from {self.model_dir}")
+
+    def score(self, query, documents, distances):
+        if not documents:
+            return []
+        self._load()
+        encodings = self._tokenizer.encode_batch([(query, document or '')
+                                                  for document in documents])
+        features = {
+            "input_ids": np.asarray([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.asarray([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.asarray([e.type_ids for e in encodings], dtype=np.int64)
+        }
+        # Передаем только входы, которые объявлены в модели
+        inputs = {i.name: features[i.name] for i in self._session.get_inputs()
+                  if i.name in features}
+        logits = self._session.run(None, inputs)[0]
+        return np.asarray(logits, dtype=np.float32).reshape(len(documents), -1)[:, -1].tolist()
+
+
+def mmr_select(query_embedding: List[float], embeddings, k: int,
+               lambda_mult: float = 0.5) -> List[int]:
+    """
+    Maximal marginal relevance: индексы k кандидатов, каждый следующий из которых
+    максимизирует lambda * sim(запрос, d) - (1 - lambda) * max sim(d, выбранные).
+    Попарные косинусные близости считаются одной матричной операцией
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    if vectors.size == 0 or k <= 0:
+        return []
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query /= np.linalg.norm(query) + 1e-12
+
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+    # Наибольшая близость каждого кандидата к уже выбранным (первым берется самый релевантный)
+    redundancy = None
+    available = np.ones(len(vectors), dtype=bool)
+    selected = []
+    for _ in range(min(k, len(vectors))):
+        scores = relevance if redundancy is None \
+            else lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        index = int(np.argmax(np.where(available, scores, -np.inf)))
+        selected.append(index)
+        available[index] = False
+        redundancy = similarity[index] if redundancy is None \
+            else np.maximum(redundancy, similarity[index])
+    return selected
+
+
+_RERANKER_CLASSES = {
+    cls.name: cls for cls in (LexicalReranker, CosineLexicalReranker, OnnxCrossEncoderReranker)
+}
+_rerankers: Dict[str, Reranker] = {}
+_rerankers_lock = threading.Lock()
+
+
+def register_reranker(cls):
+    """Регистрирует собственный скорер (подкласс Reranker с уникальным name)"""
+    _RERANKER_CLASSES[cls.name] = cls
+    return cls
+
+
+def available_rerankers() -> List[str]:
+    return list(_RERANKER_CLASSES)
+
+
+def get_reranker(name: str) -> Reranker:
+    """Экземпляр скорера по имени (один на процесс)"""
+    if name not in _RERANKER_CLASSES:
+        raise ValueError(f"Unknown reranker: {name}")
+    with _rerankers_lock:
+        if name not in _rerankers:
+            _rerankers[name] = _RERANKER_CLASSES[name]()
+        return _rerankers[name]
@@ -1,10 +1,13 @@
-from flask import Blueprint, request, jsonify
-from chroma_utils import ChromaManager
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from chroma_utils import ChromaManager, QUERY_BATCH_MAX, DOCUMENT_FIELDS
+from rerankers import available_rerankers
 from readers import DocumentReader
+from jobs import JobManager, JobStore, JOBS_DB_PATH
 import logging
 from datetime import datetime
 import json
 import os
+import threading
 
 # Получаем путь к текущей директории
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -46,6 +49,29 @@ def get_chroma_manager():
         chroma_manager = ChromaManager()
     return chroma_manager
 
+job_manager = None
+job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """
+    Ленивая инициализация очереди фоновых загрузок.
+    При создании запускает потоки, которые берут задачи из очереди,
+    в том числе прерванные перезапуском контейнера
+    """
+    global job_manager
+    if job_manager is None:
+        with job_manager_lock:
+            if job_manager is None:
+                job_manager = JobManager(
+                    JobStore(JOBS_DB_PATH),
+                    handlers={
+                        'upsert': run_upsert,
+                        'upsert_json': run_upsert_json
+                    }
+                )
+                job_manager.start()
+    return job_manager
+
 @app1.route('/health', methods=['GET'])
 def health():
     """
@@ -54,11 +80,17 @@ def health():
     """
     try:
         # Проверяем подключение к ChromaDB
-        get_chroma_manager().client.heartbeat()
+        manager = get_chroma_manager()
+        manager.client.heartbeat()
         return jsonify({
             "status": "healthy",
             "service": "chroma-api",
-            "chroma_connected": True
+            "chroma_connected": True,
+            "embedding_cache": manager.embedding_cache.stats(),
+            "query_cache": manager.query_cache.stats(),
+            "redis": manager.shared_cache.stats(),
+            "query_embedding_cache": manager.query_embedding_cache.stats(),
+            "openai_clients": manager.openai_clients.stats()
         }), 200
     except Exception as e:
         return jsonify({
@@ -100,7 +132,9 @@ def api():
             'delete_collection': handle_delete_collection,
             'show_collection': handle_show_collection,
             'count': handle_count,
-            'query': handle_query
+            'query': handle_query,
+            'query_batch': handle_query_batch,
+            'job_status': handle_job_status
         }
 
         handler = handlers.get(action)
@@ -116,6 +150,67 @@ def api():
         log_error(error_msg)
         return jsonify({"error": error_msg}), 500
 
+def submit_job(kind, data):
+    """
+    Ставит загрузку в фоновую очередь и сразу возвращает ID задачи.
+    Параметры задачи хранятся в SQLite на общем томе, поэтому ключ OpenAI
+    из запроса в фоновую задачу не передается: она использует ключ сервера
+    """
+    if data.get('openai_api_key'):
+        error_msg = "openai_api_key is not supported with async: background jobs use the server key"
+        log_error(error_msg)
+        return jsonify({"error": error_msg}), 400
+
+    job_id = get_job_manager().submit(kind, data)
+    return jsonify({
+        "status": "accepted",
+        "job_id": job_id
+    }), 202
+
+def run_upsert(data, **job_options):
+    """
+    Загрузка файла в коллекцию (в запросе или в фоновой задаче).
+    job_options - прогресс и контрольные точки фоновой задачи (см. ChromaManager.ingest)
+    """
+    file_url = data.get('file_name')
+    collection_name = data.get('collection_name')
+
+    logging.info(f"Starting file upload from {file_url} to collection {collection_name}")
+
+    # Подготавливаем метаданные
+    metadata = data.get('metadata')
+    incremental = data.get('incremental', False)
+    source = file_url
+    if incremental:
+        # Версии документа сопоставляются по полю source метаданных
+        metadata = dict(metadata or {})
+        metadata.setdefault('source', file_url)
+        source = str(metadata['source'])
+
+    # Читаем файл потоково с параметрами разделения на чанки:
+    # чтение, эмбеддинги и запись идут конвейером
+    chunks = DocumentReader.iter_chunks(
+        file_url,
+        chunk_size=data.get('chunk_size'),
+        chunk_overlap=data.get('chunk_overlap'),
+        custom_separators=data.get('custom_separators')
+    )
+
+    # Загружаем документы с переданным api_key
+    result = get_chroma_manager().ingest(
+        collection_name=collection_name,
+        items=((chunk, metadata) for chunk in chunks),
+        api_key=data.get('openai_api_key'),
+        model_name=data.get('model_name'),
+        deterministic_ids=data.get('deterministic_ids', False),
+        source=source,
+        incremental=incremental,
+        **job_options
+    )
+
+    logging.info(f"Successfully uploaded to collection {collection_name}")
+    return result
+
 def handle_upsert(data):
     """
     Обработка загрузки файлов
@@ -133,41 +228,105 @@ def handle_upsert(data):
             log_error(error_msg)
             return jsonify({"error": error_msg}), 400
 
-        logging.info(f"Starting file upload from {file_url} to collection {collection_name}")
+        if data.get('async'):
+            # Фоновая задача упала бы позже, поэтому формат проверяется до постановки в очередь
+            if not DocumentReader.is_supported(file_url):
+                error_msg = f"Unsupported file type: {file_url.split('.')[-1].lower()}"
+                log_error(error_msg)
+                return jsonify({"error": error_msg}), 400
+            return submit_job('upsert', data)
 
-        # Читаем содержимое файла с параметрами разделения на чанки
-        content = DocumentReader.read_file(
-            file_url,
-            chunk_size=data.get('chunk_size'),
-            chunk_overlap=data.get('chunk_overlap'),
-            custom_separators=data.get('custom_separators')
-        )
-
-        # Убеждаемся, что content - это список
-        if not isinstance(content, list):
-            content = [content]
-
-        # Подготавливаем метаданные
-        metadata = data.get('metadata')
-        metadata_list = [metadata] * len(content) if metadata else None
-
-        # Загружаем документы с переданным api_key
-        result = get_chroma_manager().add_documents(
-            collection_name=collection_name,
-            texts=content,
-            metadata=metadata_list,
-            api_key=data.get('openai_api_key'),
-            model_name=data.get('model_name')
-        )
-
-        logging.info(f"Successfully uploaded to collection {collection_name}")
-        return jsonify(result)
+        return jsonify(run_upsert(data))
 
     except Exception as e:
         error_msg = f"Error in upsert: {str(e)}"
         log_error(error_msg)
         return jsonify({"error": error_msg}), 500
 
+def prepare_json_documents(data):
+    """
+    Разбирает json_data на тексты и метаданные для upsert_json.
+    Возвращает (texts, metadata_list, error_msg)
+    """
+    json_data = data.get('json_data')
+    separate_chunks = data.get('separate_chunks', False)
+
+    texts = []
+    metadata_list = []
+
+    # Получаем глобальную метадату (если есть)
+    global_metadata = data.get('metadata', {})
+    if global_metadata is None:
+        global_metadata = {}
+    elif not isinstance(global_metadata, dict):
+        return None, None, "Глобальная metadata должна быть объектом"
+
+    if separate_chunks:
+        # Ожидаем, что данные передаются в виде { "questions": [ ... ] }
+        chunks = json_data.get('questions')
+        if chunks and isinstance(chunks, list):
+            for chunk in chunks:
+                if isinstance(chunk, dict):
+                    # Извлекаем текст из поля "text"
+                    text = chunk.get('text')
+                    if not text:
+                        text = ""
+                    texts.append(text)
+
+                    # Извлекаем метадату для этого чанка (если есть)
+                    chunk_metadata = chunk.get('metadata', {})
+                    if chunk_metadata is None:
+                        chunk_metadata = {}
+                    elif not isinstance(chunk_metadata, dict):
+                        return None, None, "Поле metadata для чанка должно быть объектом"
+
+                    # Объединяем глобальную метадату и метадату чанка
+                    merged_metadata = dict(global_metadata)
+                    merged_metadata.update(chunk_metadata)
+
+                    # Если ключ 'source' отсутствует, добавляем его
+                    if 'source' not in merged_metadata:
+                        merged_metadata['source'] = 'api'
+                    metadata_list.append(merged_metadata)
+                else:
+                    texts.append(str(chunk))
+                    merged_metadata = dict(global_metadata)
+                    if 'source' not in merged_metadata:
+                        merged_metadata['source'] = 'api'
+                    metadata_list.append(merged_metadata)
+        else:
+            texts.append(json.dumps(json_data, ensure_ascii=False, indent=2))
+            merged_metadata = dict(global_metadata)
+            if 'source' not in merged_metadata:
+                merged_metadata['source'] = 'api'
+            metadata_list.append(merged_metadata)
+    else:
+        texts.append(json.dumps(json_data, ensure_ascii=False, indent=2))
+        merged_metadata = dict(global_metadata)
+        if 'source' not in merged_metadata:
+            merged_metadata['source'] = 'api'
+        metadata_list.append(merged_metadata)
+
+    return texts, metadata_list, None
+
+def run_upsert_json(data, **job_options):
+    """
+    Загрузка JSON данных в коллекцию (в запросе или в фоновой задаче)
+    """
+    texts, metadata_list, error_msg = prepare_json_documents(data)
+    if error_msg:
+        raise ValueError(error_msg)
+
+    return get_chroma_manager().add_documents(
+        collection_name=data.get('collection_name'),
+        texts=texts,
+        metadata=metadata_list,
+        api_key=data.get('openai_api_key'),
+        model_name=data.get('model_name'),
+        deterministic_ids=data.get('deterministic_ids', False),
+        **job_options
+    )
+
 def handle_upsert_json(data):
     """
     Обработка загрузки JSON данных с учётом кастомной метадаты для каждого чанка.
@@ -185,79 +344,46 @@ def handle_upsert_json(data):
             log_error(error_msg)
             return jsonify({"error": error_msg}), 400
 
-        separate_chunks = data.get('separate_chunks', False)
+        # Проверяем метадату сразу, чтобы вернуть 400 и для фоновой задачи
+        _, _, error_msg = prepare_json_documents(data)
+        if error_msg:
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        if data.get('async'):
+            return submit_job('upsert_json', data)
 
-        texts = []
-        metadata_list = []
+        return jsonify(run_upsert_json(data))
 
-        # Получаем глобальную метадату (если есть)
-        global_metadata = data.get('metadata', {})
-        if global_metadata is None:
-            global_metadata = {}
-        elif not isinstance(global_metadata, dict):
-            error_msg = "Глобальная metadata должна быть объектом"
+    except Exception as e:
+        error_msg = f"Error in upsert_json: {str(e)}"
+        log_error(error_msg)
+        return jsonify({"error": error_msg}), 500
+
+def handle_job_status(data):
+    """
+    Статус и прогресс фоновой загрузки по job_id
+    """
+    try:
+        job_id = data.get('job_id')
+        if not job_id:
+            error_msg = "job_id is required"
             log_error(error_msg)
             return jsonify({"error": error_msg}), 400
 
-        if separate_chunks:
-            # Ожидаем, что данные передаются в виде { "questions": [ ... ] }
-            chunks = json_data.get('questions')
-            if chunks and isinstance(chunks, list):
-                for chunk in chunks:
-                    if isinstance(chunk, dict):
-                        # Извлекаем текст из поля "text"
-                        text = chunk.get('text')
-                        if not text:
-                            text = ""
-                        texts.append(text)
-
-                        # Извлекаем метадату для этого чанка (если есть)
-                        chunk_metadata = chunk.get('metadata', {})
-                        if chunk_metadata is None:
-                            chunk_metadata = {}
-                        elif not isinstance(chunk_metadata, dict):
-                            error_msg = "Поле metadata для чанка должно быть объектом"
-                            log_error(error_msg)
-                            return jsonify({"error": error_msg}), 400
-
-                        # Объединяем глобальную метадату и метадату чанка
-                        merged_metadata = dict(global_metadata)
-                        merged_metadata.update(chunk_metadata)
-
-                        # Если ключ 'source' отсутствует, добавляем его
-                        if 'source' not in merged_metadata:
-                            merged_metadata['source'] = 'api'
-                        metadata_list.append(merged_metadata)
-                    else:
-                        texts.append(str(chunk))
-                        merged_metadata = dict(global_metadata)
-                        if 'source' not in merged_metadata:
-                            merged_metadata['source'] = 'api'
-                        metadata_list.append(merged_metadata)
-            else:
-                texts.append(json.dumps(json_data, ensure_ascii=False, indent=2))
-                merged_metadata = dict(global_metadata)
-                if 'source' not in merged_metadata:
-                    merged_metadata['source'] = 'api'
-                metadata_list.append(merged_metadata)
-        else:
-            texts.append(json.dumps(json_data, ensure_ascii=False, indent=2))
-            merged_metadata = dict(global_metadata)
-            if 'source' not in merged_metadata:
-                merged_metadata['source'] = 'api'
-            metadata_list.append(merged_metadata)
+        job = get_job_manager().status(job_id)
+        if job is None:
+            error_msg = f"Job not found: {job_id}"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 404
 
-        result = get_chroma_manager().add_documents(
-            collection_name=collection_name,
-            texts=texts,
-            metadata=metadata_list,
-            api_key=data.get('openai_api_key'),
-            model_name=data.get('model_name')
-        )
-        return jsonify(result)
+        return jsonify({
+            "status": "success",
+            "job": job
+        })
 
     except Exception as e:
-        error_msg = f"Error in upsert_json: {str(e)}"
+        error_msg = f"Error in job_status: {str(e)}"
         log_error(error_msg)
         return jsonify({"error": error_msg}), 500
 
@@ -277,7 +403,8 @@ def handle_delete_file(data):
 
         result = get_chroma_manager().delete_documents(
             collection_name=collection_name,
-            filters=filters
+            filters=filters,
+            return_ids=bool(data.get('return_ids', False))
         )
         return jsonify(result)
 
@@ -316,11 +443,56 @@ def handle_show_collection(data):
             log_error(error_msg)
             return jsonify({"error": error_msg}), 400
 
-        filters = data.get('filters', {})
+        filters = data.get('filters') or {}
+
+        # include - проекция полей: [] - только ID, ["metadatas"] - ID и метаданные и т.д.
+        # Прежний формат - include внутри filters
+        include = data.get('include')
+        if include is None:
+            include = filters.get('include')
+        if include is not None and (not isinstance(include, list)
+                                    or any(field not in DOCUMENT_FIELDS for field in include)):
+            error_msg = f"include must be a list of: {', '.join(DOCUMENT_FIELDS)}"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
 
-        result = get_chroma_manager().get_documents(
+        manager = get_chroma_manager()
+        limit = data.get('limit')
+        offset = data.get('offset')
+        if data.get('cursor'):
+            try:
+                offset = manager.decode_cursor(data['cursor'])
+            except ValueError as e:
+                log_error(str(e))
+                return jsonify({"error": str(e)}), 400
+
+        if data.get('stream'):
+            # NDJSON: по записи на строку, коллекция читается из Chroma страницами
+            records = manager.iter_documents(
+                collection_name=collection_name,
+                filters=filters,
+                include=include,
+                limit=limit if limit is not None else filters.get('limit'),
+                offset=offset if offset is not None else filters.get('offset', 0)
+            )
+
+            def generate():
+                try:
+                    for record in records:
+                        yield json.dumps(record, ensure_ascii=False) + '\n'
+                except Exception as e:
+                    error_msg = f"Error in show_collection stream: {str(e)}"
+                    log_error(error_msg)
+                    yield json.dumps({"error": error_msg}, ensure_ascii=False) + '\n'
+
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        result = manager.get_documents(
             collection_name=collection_name,
-            filters=filters
+            filters=filters,
+            include=include,
+            limit=limit,
+            offset=offset
         )
         return jsonify(result)
 
@@ -354,7 +526,14 @@ def handle_query(data):
     """
     try:
         collection_name = data.get('collection_name')
-        if not collection_name:
+        # collection_names - федеративный поиск по нескольким коллекциям
+        collection_names = data.get('collection_names')
+        if collection_names is not None and (
+                not isinstance(collection_names, list) or not collection_names):
+            error_msg = "collection_names must be a non-empty list"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+        if not collection_name and not collection_names:
             error_msg = "collection_name is required"
             log_error(error_msg)
             return jsonify({"error": error_msg}), 400
@@ -369,13 +548,79 @@ def handle_query(data):
         model_name = data.get('model_name', 'text-embedding-3-large')
         filters = data.get('filters')  # Получаем фильтры из запроса
 
+        # vector - по эмбеддингам, lexical - BM25, hybrid - оба с объединением рангов
+        mode = data.get('mode', 'vector')
+        if mode not in ('vector', 'lexical', 'hybrid'):
+            error_msg = f"Unknown mode: {mode}"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        # rerank - имя скорера для переранжирования расширенного набора кандидатов
+        rerank = data.get('rerank')
+        if rerank and rerank not in available_rerankers():
+            error_msg = f"Unknown rerank: {rerank} (available: {', '.join(available_rerankers())})"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        # rerank_factor - во сколько раз больше n_results кандидатов запросить
+        rerank_factor = data.get('rerank_factor')
+        if isinstance(rerank_factor, str) and rerank_factor.strip().isdigit():
+            rerank_factor = int(rerank_factor)
+        if rerank_factor is not None and (isinstance(rerank_factor, bool) or
+                                          not isinstance(rerank_factor, int) or rerank_factor < 1):
+            error_msg = "rerank_factor must be an integer >= 1"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        mmr = bool(data.get('mmr', False))
+        if mmr and (rerank or mode != 'vector'):
+            error_msg = "mmr is supported only in vector mode without rerank"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        # mmr_lambda - вес релевантности в MMR от 0 до 1
+        mmr_lambda = data.get('mmr_lambda', 0.5)
+        try:
+            mmr_lambda = None if isinstance(mmr_lambda, bool) else float(mmr_lambda)
+        except (TypeError, ValueError):
+            mmr_lambda = None
+        if mmr_lambda is None or not 0 <= mmr_lambda <= 1:
+            error_msg = "mmr_lambda must be a number from 0 to 1"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        # Федеративный поиск объединяет результаты по косинусному расстоянию,
+        # поэтому гибридный/лексический режим, rerank и mmr с ним не совмещаются
+        if collection_names and (mode != 'vector' or rerank or mmr):
+            error_msg = "mode, rerank and mmr are not supported with collection_names"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        if collection_names:
+            result = get_chroma_manager().query_collections(
+                collection_names=collection_names,
+                query_text=query_text,
+                n_results=n_results,
+                api_key=data.get('openai_api_key'),
+                model_name=model_name,
+                filters=filters,
+                use_cache=data.get('use_cache', True)
+            )
+            return jsonify(result)
+
         result = get_chroma_manager().query_collection(
             collection_name=collection_name,
             query_text=query_text,
             n_results=n_results,
             api_key=data.get('openai_api_key'),
             model_name=model_name,
-            filters=filters  # Передаём фильтры в функцию
+            filters=filters,  # Передаём фильтры в функцию
+            use_cache=data.get('use_cache', True),
+            mode=mode,
+            rerank=rerank,
+            rerank_factor=rerank_factor,
+            mmr=mmr,
+            mmr_lambda=mmr_lambda
         )
         return jsonify(result)
 
@@ -383,3 +628,53 @@ def handle_query(data):
         error_msg = f"Error in query: {str(e)}"
         log_error(error_msg)
         return jsonify({"error": error_msg}), 500
+
+def handle_query_batch(data):
+    """
+    Пакетный поиск: список запросов (возможно, к разным коллекциям) за один вызов.
+    collection_name, n_results и filters верхнего уровня - значения по умолчанию для запросов
+    """
+    try:
+        queries = data.get('queries')
+        if not isinstance(queries, list) or not queries:
+            error_msg = "queries must be a non-empty list"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+        if len(queries) > QUERY_BATCH_MAX:
+            error_msg = f"Too many queries: {len(queries)} (max {QUERY_BATCH_MAX})"
+            log_error(error_msg)
+            return jsonify({"error": error_msg}), 400
+
+        prepared = []
+        for i, item in enumerate(queries):
+            # Запрос можно передать строкой или объектом с собственными параметрами
+            if isinstance(item, str):
+                item = {"query": item}
+            if not isinstance(item, dict) or not item.get('query'):
+                error_msg = f"queries[{i}]: query is required"
+                log_error(error_msg)
+                return jsonify({"error": error_msg}), 400
+            collection_name = item.get('collection_name', data.get('collection_name'))
+            if not collection_name:
+                error_msg = f"queries[{i}]: collection_name is required"
+                log_error(error_msg)
+                return jsonify({"error": error_msg}), 400
+            prepared.append({
+                "collection_name": collection_name,
+                "query": item['query'],
+                "n_results": item.get('n_results', data.get('n_results', 4)),
+                "filters": item.get('filters', data.get('filters'))
+            })
+
+        result = get_chroma_manager().query_batch(
+            queries=prepared,
+            api_key=data.get('openai_api_key'),
+            model_name=data.get('model_name', 'text-embedding-3-large'),
+            use_cache=data.get('use_cache', True)
+        )
+        return jsonify(result)
+
+    except Exception as e:
+        error_msg = f"Error in query_batch: {str(e)}"
+        log_error(error_msg)
+        return jsonify({"error": error_msg}), 500
@@ -0,0 +1,40 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# Модули chroma-api импортируются как в контейнере - из каталога приложения
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_chroma_client = None
+
+
+@pytest.fixture
+def manager():
+    """ChromaManager без подключения к серверу: встроенный Chroma, без индексов и кэша"""
+    global _chroma_client
+    import chromadb
+    from chromadb.config import Settings
+    from chroma_utils import ChromaManager, QueryResultCache
+
+    if _chroma_client is None:
+        _chroma_client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+    manager = object.__new__(ChromaManager)
+    manager.client = _chroma_client
+    manager.lexical_index = None
+    manager.query_cache = QueryResultCache(0, 0)
+    return manager
+
+
+@pytest.fixture
+def collection(manager):
+    """Коллекция из 10 записей: source "a" у id1, id2, id4, id5, id7, id8, остальные - "b\""""
+    name = f"test-{uuid.uuid4().hex[:8]}"
+    collection = manager.client.create_collection(name)
+    collection.add(ids=[f"id{i}" for i in range(10)],
+                   documents=[f"doc {i}" for i in range(10)],
+                   embeddings=[[float(i), 1.0] for i in range(10)],
+                   metadatas=[{"source": "a" if i % 3 else "b"} for i in range(10)])
+    yield collection
+    manager.client.delete_collection(name)
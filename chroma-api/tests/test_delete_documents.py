@@ -0,0 +1,32 @@
+import pytest
+
+import chroma_utils
+
+
+@pytest.mark.parametrize('batch_size', [1000, 1])
+def test_delete_where_with_offset_keeps_first_matches(manager, collection, monkeypatch,
+                                                      batch_size):
+    monkeypatch.setattr(chroma_utils, 'DELETE_BATCH_SIZE', batch_size)
+    expected = collection.get(where={"source": "a"}, offset=2, include=[])['ids']
+
+    result = manager.delete_documents(collection.name,
+                                      {"where": {"source": "a"}, "offset": 2},
+                                      return_ids=True)
+
+    assert result["deleted"] == len(expected) == 4
+    assert sorted(result["ids"]) == sorted(expected)
+    assert len(collection.get(where={"source": "a"}, include=[])['ids']) == 2
+    assert len(collection.get(where={"source": "b"}, include=[])['ids']) == 4
+
+
+@pytest.mark.parametrize('batch_size', [1000, 1])
+def test_delete_where_with_offset_and_limit(manager, collection, monkeypatch, batch_size):
+    monkeypatch.setattr(chroma_utils, 'DELETE_BATCH_SIZE', batch_size)
+    expected = collection.get(where={"source": "a"}, offset=1, limit=3, include=[])['ids']
+
+    result = manager.delete_documents(collection.name,
+                                      {"where": {"source": "a"}, "offset": 1, "limit": 3},
+                                      return_ids=True)
+
+    assert sorted(result["ids"]) == sorted(expected)
+    assert collection.count() == 7
@@ -0,0 +1,166 @@
+import os
+import time
+
+import pytest
+
+import readers
+from readers import DocumentReader, DownloadCache
+
+URL = 'http://files.example/doc.txt'
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, body: bytes = b'', headers: dict = None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise readers.requests.HTTPError(str(self.status_code))
+
+    def iter_content(self, size: int):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+
+class FakeSession:
+    """Сервер с одной версией файла: отвечает 304 на совпавший If-None-Match"""
+
+    def __init__(self, body: bytes, etag: str):
+        self.body = body
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        if (headers or {}).get('If-None-Match') == self.etag:
+            return FakeResponse(304)
+        return FakeResponse(200, self.body, {'ETag': self.etag,
+                                             'Content-Type': 'text/plain; charset=utf-8'})
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = FakeSession('Первая версия. Текст документа.'.encode('utf-8'), '"v1"')
+    monkeypatch.setattr(readers, 'get_session', lambda: session)
+    return session
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    monkeypatch.setattr(readers, 'download_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def splits(monkeypatch):
+    """Считает разборы текста: чанки из кэша split_stream не вызывают"""
+    calls = []
+    split_stream = DocumentReader.split_stream
+
+    def counting(*args, **kwargs):
+        calls.append(kwargs.get('chunk_size'))
+        return split_stream(*args, **kwargs)
+    monkeypatch.setattr(DocumentReader, 'split_stream', staticmethod(counting))
+    return calls
+
+
+def _chunk_files(cache: DownloadCache) -> list:
+    entry_dir = cache._entry_dir(URL)
+    return sorted(name for name in os.listdir(entry_dir) if name.startswith('chunks-'))
+
+
+def test_not_modified_reuses_body_and_chunks(session, cache, splits):
+    first = list(DocumentReader.iter_chunks(URL, chunk_size=20, chunk_overlap=0))
+    second = list(DocumentReader.iter_chunks(URL, chunk_size=20, chunk_overlap=0))
+
+    assert second == first
+    assert len(splits) == 1
+    assert session.requests == [{}, {'If-None-Match': '"v1"'}]
+    assert len(_chunk_files(cache)) == 1
+
+
+def test_new_etag_invalidates_chunks(session, cache, splits):
+    list(DocumentReader.iter_chunks(URL, chunk_size=20, chunk_overlap=0))
+    old_files = _chunk_files(cache)
+
+    session.body = 'Вторая версия.'.encode('utf-8')
+    session.etag = '"v2"'
+    chunks = list(DocumentReader.iter_chunks(URL, chunk_size=20, chunk_overlap=0))
+
+    assert chunks == ['Вторая версия']
+    assert len(splits) == 2
+    # Чанки прежней версии удалены, сохранены только новые
+    assert len(_chunk_files(cache)) == 1
+    assert _chunk_files(cache) != old_files
+
+
+def test_chunk_params_change_key(session, cache, splits):
+    small = list(DocumentReader.iter_chunks(URL, chunk_size=20, chunk_overlap=0))
+    large = list(DocumentReader.iter_chunks(URL, chunk_size=1000, chunk_overlap=0))
+
+    assert small != large
+    assert splits == [20, 1000]
+    assert cache._chunks_path(URL, '"v1"', {'chunk_size': 20}) != \
+        cache._chunks_path(URL, '"v1"', {'chunk_size': 1000})
+
+
+def test_interrupted_read_saves_no_chunks(session, cache):
+    chunks = DocumentReader.iter_chunks(URL, chunk_size=20, chunk_overlap=0)
+    next(chunks)
+    chunks.close()
+
+    entry_dir = cache._entry_dir(URL)
+    assert _chunk_files(cache) == []
+    assert not [name for name in os.listdir(entry_dir) if name.startswith('.tmp-')]
+
+
+def _entry_size(cache: DownloadCache, url: str) -> int:
+    entry_dir = cache._entry_dir(url)
+    return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+
+def test_evicts_least_recently_used_over_size(session, cache):
+    urls = [f'http://files.example/{i}.txt' for i in range(3)]
+    for age, url in enumerate(urls):
+        cache.get(url)
+        used = time.time() - 100 + age
+        os.utime(os.path.join(cache._entry_dir(url), 'meta.json'), (used, used))
+    # Все три записи не помещаются, две - помещаются
+    cache.max_bytes = sum(_entry_size(cache, url) for url in urls) - 1
+
+    cache.get(urls[0])  # 304: запись снова используется
+    cache.evict()
+
+    assert os.path.exists(cache._entry_dir(urls[0]))
+    assert not os.path.exists(cache._entry_dir(urls[1]))
+    assert os.path.exists(cache._entry_dir(urls[2]))
+
+
+def test_evicts_expired_entries_and_stale_links(session, cache, monkeypatch):
+    cache.max_age = 60
+    cache.get(URL)
+    entry_dir = cache._entry_dir(URL)
+    old = time.time() - 120
+    os.utime(os.path.join(entry_dir, 'meta.json'), (old, old))
+
+    # Свежая ссылка - тело сейчас разбирается, запись не удаляется
+    with open(os.path.join(entry_dir, 'body'), 'rb') as body:
+        link = DocumentReader._link_open_file(body)
+    cache.evict()
+    assert os.path.exists(link)
+
+    # Ссылка брошена упавшим воркером: удаляется вместе с устаревшей записью
+    monkeypatch.setattr(DownloadCache, 'STALE_SECONDS', 0)
+    time.sleep(0.01)
+    cache.evict()
+
+    assert not os.path.exists(entry_dir)
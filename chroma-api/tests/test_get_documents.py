@@ -0,0 +1,36 @@
+import chroma_utils
+
+
+def test_include_in_filters_is_forwarded(manager, collection):
+    result = manager.get_documents(collection.name, {"include": ["metadatas"], "limit": 3})
+
+    assert result["included"] == ["metadatas"]
+    assert "documents" not in result
+    assert len(result["metadatas"]) == 3
+
+
+def test_top_level_include_wins(manager, collection):
+    result = manager.get_documents(collection.name, {"include": ["metadatas"]},
+                                   include=["documents"], limit=2)
+
+    assert result["included"] == ["documents"]
+
+
+def test_page_cut_by_server_limit_is_flagged(manager, collection, monkeypatch):
+    monkeypatch.setattr(chroma_utils, 'SHOW_COLLECTION_MAX_LIMIT', 4)
+
+    result = manager.get_documents(collection.name, {})
+    assert result["truncated"] is True
+    assert manager.decode_cursor(result["next_cursor"]) == 4
+
+    result = manager.get_documents(collection.name, {"limit": 100})
+    assert result["truncated"] is True
+
+    # Страница по limit клиента - обычная пагинация, не обрезка
+    result = manager.get_documents(collection.name, {}, limit=4)
+    assert "truncated" not in result
+    assert "next_cursor" in result
+
+    result = manager.get_documents(collection.name, {}, offset=8)
+    assert len(result["ids"]) == 2
+    assert "truncated" not in result and "next_cursor" not in result
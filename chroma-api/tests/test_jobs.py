@@ -0,0 +1,138 @@
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import JobManager, JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / 'jobs.sqlite'))
+
+
+def _raw_payload(store: JobStore, job_id: str):
+    with sqlite3.connect(store.path) as conn:
+        return conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+
+def test_concurrent_claims_take_each_job_once(store):
+    job_ids = {store.create('upsert', {"n": i}) for i in range(20)}
+    # У каждого претендента свой JobStore, как у разных воркеров gunicorn
+    claimers = [JobStore(store.path) for _ in range(8)]
+    barrier = threading.Barrier(len(claimers))
+    claimed = []
+
+    def claim_all(claimer: JobStore, owner: str):
+        barrier.wait()
+        while True:
+            job = claimer.claim(owner)
+            if job is None:
+                return
+            claimed.append(job["job_id"])
+
+    threads = [threading.Thread(target=claim_all, args=(claimer, f"worker-{i}"))
+               for i, claimer in enumerate(claimers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(job_ids)
+
+
+def test_single_job_has_one_winner(store):
+    job_id = store.create('upsert', {})
+    barrier = threading.Barrier(2)
+    results = []
+
+    def claim(owner: str):
+        claimer = JobStore(store.path)
+        barrier.wait()
+        results.append(claimer.claim(owner))
+
+    threads = [threading.Thread(target=claim, args=(owner,)) for owner in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [job for job in results if job is not None]
+    assert [job["job_id"] for job in winners] == [job_id]
+
+
+def test_expired_lease_is_reclaimed_from_checkpoint(store, monkeypatch):
+    job_id = store.create('upsert', {"collection_name": "col"})
+    monkeypatch.setattr(jobs, 'JOB_LEASE_SECONDS', 0.05)
+    first = store.claim('crashed')
+    store.update(job_id, checkpoint=300)
+
+    # Аренда действует - задачу не забирают
+    assert store.claim('other') is None
+    time.sleep(0.1)
+
+    monkeypatch.setattr(jobs, 'JOB_LEASE_SECONDS', 60)
+    resumed = store.claim('other')
+    assert first["attempts"] == 1
+    assert resumed["job_id"] == job_id
+    assert resumed["checkpoint"] == 300
+    assert resumed["attempts"] == 2
+    assert resumed["payload"] == {"collection_name": "col"}
+    # Прежний владелец больше не может продлить аренду
+    assert not store.renew(job_id, 'crashed')
+    assert store.renew(job_id, 'other')
+
+    calls = []
+
+    def handler(data, on_progress, id_namespace, resume_from, on_checkpoint):
+        calls.append((data, id_namespace, resume_from))
+        on_checkpoint(500)
+        return {"status": "success"}
+
+    JobManager(store, {'upsert': handler}, workers=1)._run(resumed)
+
+    assert calls == [({"collection_name": "col"}, job_id, 300)]
+    status = store.get(job_id)
+    assert status["state"] == 'completed'
+    assert status["checkpoint"] == 500
+    assert _raw_payload(store, job_id) is None
+
+
+def test_job_past_max_attempts_is_failed(store, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_MAX_ATTEMPTS', 2)
+    monkeypatch.setattr(jobs, 'JOB_LEASE_SECONDS', 0)
+    job_id = store.create('upsert', {"collection_name": "col"})
+
+    assert store.claim('a')["attempts"] == 1
+    time.sleep(0.01)
+    assert store.claim('b')["attempts"] == 2
+    time.sleep(0.01)
+    assert store.claim('c') is None
+
+    status = store.get(job_id)
+    assert status["state"] == 'failed'
+    assert status["error"] == "Job abandoned after 2 attempts"
+    assert _raw_payload(store, job_id) is None
+
+
+def test_secret_fields_are_not_stored(store):
+    job_id = store.create('upsert', {"collection_name": "col", "openai_api_key": "sk-secret"})
+
+    payload = json.loads(_raw_payload(store, job_id))
+    assert payload == {"collection_name": "col"}
+    assert store.claim('a')["payload"] == {"collection_name": "col"}
+
+
+def test_secrets_saved_by_older_versions_are_removed(store):
+    job_id = store.create('upsert', {"collection_name": "col"})
+    with sqlite3.connect(store.path) as conn:
+        conn.execute("UPDATE jobs SET payload = ? WHERE id = ?",
+                     (json.dumps({"collection_name": "col", "openai_api_key": "sk-secret"}),
+                      job_id))
+
+    JobStore(store.path)
+
+    assert json.loads(_raw_payload(store, job_id)) == {"collection_name": "col"}
@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from pipeline import IngestionPipeline
+
+
+class StubManager:
+    """Минимум ChromaManager для конвейера: эмбеддинги с задержкой вразнобой"""
+    lexical_index = None
+
+    def __init__(self):
+        self.query_cache = SimpleNamespace(invalidate=lambda name: None)
+        self._rnd = random.Random(0)
+        self._lock = threading.Lock()
+
+    def _clean_metadata(self, meta):
+        return meta
+
+    def _content_id(self, namespace, index, text):
+        return f"{namespace}-{index}"
+
+    def _create_embeddings(self, texts, api_key=None, model_name=None):
+        with self._lock:
+            delay = self._rnd.random() / 100
+        time.sleep(delay)
+        return [[0.0] for _ in texts]
+
+    def _max_write_batch(self):
+        return 1000
+
+    def _write_batches(self, documents, metadatas, ids, embeddings, max_records):
+        yield 0, len(ids)
+
+
+def _collection(written: list):
+    return SimpleNamespace(name='stub', add=None,
+                           upsert=lambda ids, **kwargs: written.extend(ids))
+
+
+def _pipeline(items, **kwargs):
+    return IngestionPipeline(StubManager(), _collection([]), items, **kwargs)
+
+
+def test_checkpoint_waits_for_earlier_batches():
+    checkpoints = []
+    pipeline = _pipeline([], id_namespace='job', on_checkpoint=checkpoints.append)
+
+    pipeline._complete(1, 200)
+    pipeline._complete(2, 300)
+    assert checkpoints == []
+
+    pipeline._complete(0, 100)
+    assert checkpoints == [300]
+
+    pipeline._complete(4, 500)
+    pipeline._complete(3, 400)
+    assert checkpoints == [300, 500]
+
+
+def test_checkpoints_are_monotonic_with_parallel_embedding():
+    checkpoints = []
+    written = []
+    items = [(f"chunk {i}", {"source": "t"}) for i in range(1000)]
+    pipeline = IngestionPipeline(StubManager(), _collection(written), items,
+                                 batch_size=10, embed_workers=4, queue_size=8,
+                                 id_namespace='job', on_checkpoint=checkpoints.append)
+
+    pipeline.run()
+
+    assert checkpoints == sorted(checkpoints)
+    assert checkpoints[-1] == 1000
+    assert sorted(written) == sorted(f"job-{i}" for i in range(1000))
+
+
+def test_resume_skips_checkpointed_prefix_with_same_ids():
+    written = []
+    items = [(f"chunk {i}", {"source": "t"}) for i in range(95)]
+    pipeline = IngestionPipeline(StubManager(), _collection(written), items,
+                                 batch_size=10, id_namespace='job', resume_from=40)
+
+    pipeline.run()
+
+    assert pipeline.ids == [f"job-{i}" for i in range(95)]
+    assert sorted(written) == sorted(f"job-{i}" for i in range(40, 95))
+    assert pipeline.stats["read"] == 95
+    assert pipeline.stats["written"] == 55
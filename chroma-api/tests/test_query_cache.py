@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+import chroma_utils  # noqa: E402
+from chroma_utils import QueryResultCache, RedisCache  # noqa: E402
+
+RESULT = {"status": "success", "results": {"ids": ["a"]}}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Один FakeServer на все клиенты теста - как общий service_redis у воркеров"""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(chroma_utils.redis.Redis, 'from_url',
+                        lambda url, **kwargs: fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(RedisCache, 'RETRY_INTERVAL', 0.1)
+    return server
+
+
+def _worker() -> QueryResultCache:
+    return QueryResultCache(100, 300, shared=RedisCache('redis://service_redis:6379/1'),
+                            workers=4)
+
+
+def _cached(cache: QueryResultCache):
+    return cache.get('col', cache.version('col'), 'key')
+
+
+def test_invalidation_reaches_other_worker(server):
+    writer, reader = _worker(), _worker()
+    reader.put('col', reader.version('col'), 'key', RESULT)
+    assert _cached(reader) == RESULT
+
+    writer.invalidate('col')
+
+    assert _cached(reader) is None
+
+
+def test_failed_invalidation_is_retried_and_never_served(server):
+    writer, reader = _worker(), _worker()
+    reader.put('col', reader.version('col'), 'key', RESULT)
+    writer.put('col', writer.version('col'), 'key', RESULT)
+
+    server.connected = False
+    writer.invalidate('col')
+
+    # Redis недоступен: ни один воркер не отдает и не сохраняет результаты коллекции
+    assert writer.stats()["pending_invalidations"] == 1
+    assert _cached(writer) is None
+    assert _cached(reader) is None
+    writer.put('col', writer.version('col'), 'key', RESULT)
+    reader.put('col', reader.version('col'), 'key', RESULT)
+
+    # Пока Redis лежит, фоновые повторы не удаются и планируются снова
+    time.sleep(0.25)
+    assert writer.stats()["pending_invalidations"] == 1
+
+    server.connected = True
+    time.sleep(0.25)
+    # Инвалидация повторена в фоне, без новых обращений к писавшему воркеру
+    assert writer.stats()["pending_invalidations"] == 0
+    assert _cached(reader) is None
+    assert _cached(writer) is None
+
+    writer.put('col', writer.version('col'), 'key', RESULT)
+    assert _cached(reader) == RESULT
+
+
+def test_invalidation_ignores_cooldown(server):
+    writer, reader = _worker(), _worker()
+    reader.put('col', reader.version('col'), 'key', RESULT)
+    writer.shared._down_until = time.monotonic() + 60
+
+    writer.invalidate('col')
+
+    assert writer.stats()["pending_invalidations"] == 0
+    assert _cached(reader) is None
+
+
+def test_local_versions_only_with_single_worker():
+    assert not QueryResultCache(100, 300, shared=RedisCache(''), workers=4).enabled
+
+    cache = QueryResultCache(100, 300, shared=RedisCache(''), workers=1)
+    cache.put('col', cache.version('col'), 'key', RESULT)
+    assert _cached(cache) == RESULT
+    cache.invalidate('col')
+    assert _cached(cache) is None
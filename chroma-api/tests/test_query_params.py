@@ -0,0 +1,69 @@
+import pytest
+from flask import Flask
+
+import routes
+
+
+class StubManager:
+    def __init__(self):
+        self.calls = []
+
+    def query_collection(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"status": "success", "results": {}}
+
+
+@pytest.fixture
+def manager(monkeypatch, tmp_path):
+    manager = StubManager()
+    monkeypatch.setattr(routes, 'get_chroma_manager', lambda: manager)
+    monkeypatch.setattr(routes, 'ERROR_LOG_PATH', str(tmp_path / 'error.txt'))
+    return manager
+
+
+def _query(**params):
+    with Flask(__name__).app_context():
+        response = routes.handle_query({"collection_name": "col", "query": "текст", **params})
+    if isinstance(response, tuple):
+        return response[0].get_json(), response[1]
+    return response.get_json(), 200
+
+
+@pytest.mark.parametrize('value,parsed', [(None, None), (1, 1), (8, 8), ("3", 3)])
+def test_rerank_factor_accepted(manager, value, parsed):
+    body, status = _query(rerank='lexical', rerank_factor=value)
+
+    assert status == 200
+    assert manager.calls[0]["rerank_factor"] == parsed
+
+
+@pytest.mark.parametrize('value', [0, -2, 2.5, "2.5", "abc", True, [4], {}])
+def test_rerank_factor_rejected(manager, value):
+    body, status = _query(rerank='lexical', rerank_factor=value)
+
+    assert status == 400
+    assert body == {"error": "rerank_factor must be an integer >= 1"}
+    assert manager.calls == []
+
+
+@pytest.mark.parametrize('value,parsed', [(0, 0.0), (1, 1.0), (0.3, 0.3), ("0.7", 0.7)])
+def test_mmr_lambda_accepted(manager, value, parsed):
+    body, status = _query(mmr=True, mmr_lambda=value)
+
+    assert status == 200
+    assert manager.calls[0]["mmr_lambda"] == parsed
+
+
+def test_mmr_lambda_default(manager):
+    _query(mmr=True)
+
+    assert manager.calls[0]["mmr_lambda"] == 0.5
+
+
+@pytest.mark.parametrize('value', [-0.1, 1.5, "nan", "abc", None, True, [0.5]])
+def test_mmr_lambda_rejected(manager, value):
+    body, status = _query(mmr=True, mmr_lambda=value)
+
+    assert status == 400
+    assert body == {"error": "mmr_lambda must be a number from 0 to 1"}
+    assert manager.calls == []
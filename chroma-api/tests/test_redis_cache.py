@@ -0,0 +1,125 @@
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+import chroma_utils  # noqa: E402
+from chroma_utils import EmbeddingCache, RedisCache  # noqa: E402
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Один FakeServer на все клиенты теста - как общий service_redis у воркеров"""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(chroma_utils.redis.Redis, 'from_url',
+                        lambda url, **kwargs: fakeredis.FakeRedis(server=server))
+    return server
+
+
+def test_get_set_and_many(server):
+    cache = RedisCache('redis://service_redis:6379/0')
+
+    cache.set('q', 'a', b'1', ttl=60)
+    cache.set_many('q', {'b': b'2', 'c': b'3'}, ttl=0)
+
+    assert cache.get('q', 'a') == b'1'
+    assert cache.get_many('q', ['a', 'x', 'c']) == [b'1', None, b'3']
+    assert cache.get_many('q', []) == []
+    assert cache.get('other', 'a') is None
+
+
+def test_namespace_bump(server):
+    cache = RedisCache('redis://service_redis:6379/0')
+
+    assert cache.namespace_version('col') == 0
+    cache.bump_namespace('col')
+    cache.bump_namespace('col')
+    assert cache.namespace_version('col') == 2
+    # Счетчик общий: другой воркер видит то же поколение
+    assert RedisCache('redis://service_redis:6379/0').namespace_version('col') == 2
+    assert cache.namespace_version('other') == 0
+
+
+def test_not_configured():
+    cache = RedisCache('')
+
+    assert not cache.available
+    assert cache.namespace_version('col') is None
+    assert cache.get('q', 'a') is None
+    assert cache.get_many('q', ['a', 'b']) == [None, None]
+    cache.set_many('q', {'a': b'1'}, ttl=0)
+    assert cache.stats() == {"configured": False, "available": False}
+
+
+def test_unavailable_redis_falls_back_and_cools_down(server, monkeypatch):
+    monkeypatch.setattr(RedisCache, 'RETRY_INTERVAL', 0.2)
+    cache = RedisCache('redis://service_redis:6379/0')
+    cache.set('q', 'a', b'1', ttl=0)
+
+    server.connected = False
+    assert cache.get('q', 'a') is None
+    assert not cache.available
+    assert cache.namespace_version('col') is None
+    assert cache.get_many('q', ['a']) == [None]
+
+    # До конца паузы Redis не опрашивается, даже если уже поднялся
+    server.connected = True
+    assert cache.get('q', 'a') is None
+
+    time.sleep(0.25)
+    assert cache.available
+    assert cache.get('q', 'a') == b'1'
+
+
+def test_set_many_failure_starts_cooldown(server, monkeypatch):
+    monkeypatch.setattr(RedisCache, 'RETRY_INTERVAL', 30)
+    cache = RedisCache('redis://service_redis:6379/0')
+
+    server.connected = False
+    cache.set_many('q', {'a': b'1'}, ttl=0)
+
+    assert not cache.available
+    assert cache.stats() == {"configured": True, "available": False}
+
+
+def test_pack_unpack_float32():
+    embedding = [0.0, 1.0, -2.5, 0.1, 1e-3, 3.4e38]
+
+    data = EmbeddingCache.pack(embedding)
+
+    assert len(data) == 4 * len(embedding)
+    assert EmbeddingCache.unpack(data) == pytest.approx(embedding, rel=1e-6)
+    # Значение уже в float32 упаковывается без потерь
+    restored = EmbeddingCache.unpack(data)
+    assert EmbeddingCache.unpack(EmbeddingCache.pack(restored)) == restored
+
+
+def test_embedding_shared_between_workers(server):
+    shared = RedisCache('redis://service_redis:6379/0')
+    first = EmbeddingCache(1024 * 1024, shared=shared)
+    second = EmbeddingCache(1024 * 1024, shared=RedisCache('redis://service_redis:6379/0'))
+    digest = EmbeddingCache.digest('текст')
+
+    first.put_many('model', {digest: [0.5, -0.25]})
+
+    assert second.get_many('model', [digest, 'missing']) == {digest: [0.5, -0.25]}
+    assert second.stats()["shared_hits"] == 1
+    assert second.stats()["misses"] == 1
+    # Найденное в Redis попало в локальный LRU
+    assert second.get_many('model', [digest]) == {digest: [0.5, -0.25]}
+    assert second.stats()["hits"] == 1
+
+
+def test_embedding_cache_without_redis_uses_local_tiers(server, tmp_path):
+    server.connected = False
+    cache = EmbeddingCache(1024 * 1024, cache_dir=str(tmp_path),
+                           shared=RedisCache('redis://service_redis:6379/0'))
+    digest = EmbeddingCache.digest('текст')
+
+    cache.put_many('model', {digest: [1.0]})
+    other = EmbeddingCache(0, cache_dir=str(tmp_path),
+                           shared=RedisCache('redis://service_redis:6379/0'))
+
+    assert other.get_many('model', [digest]) == {digest: [1.0]}
+    assert other.stats()["disk_hits"] == 1
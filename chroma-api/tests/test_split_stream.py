@@ -0,0 +1,137 @@
+import random
+
+import pytest
+
+import readers
+from readers import DocumentReader
+
+
+def _random_text(rnd: random.Random, words: list) -> str:
+    parts = []
+    for word in words:
+        parts.append(word)
+        parts.append(rnd.choice([' ', ' ', ' ', '. ', '\n', '\n\n']))
+    return ''.join(parts)
+
+
+def _random_pieces(rnd: random.Random, text: str) -> list:
+    """Режет текст в случайных местах, в том числе посреди слов и разделителей"""
+    cuts = sorted(rnd.sample(range(1, len(text)), rnd.randint(1, 20)))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def _tokens(text: str) -> list:
+    return text.replace('.', ' ').split()
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_size_limit_and_no_dropped_content(seed):
+    rnd = random.Random(seed)
+    text = _random_text(rnd, [f"w{i}" for i in range(rnd.randint(50, 3000))])
+    chunk_size = rnd.choice([100, 300, 1000])
+    chunk_overlap = rnd.choice([0, 20, 50])
+
+    chunks = list(DocumentReader.split_stream(_random_pieces(rnd, text),
+                                              chunk_size, chunk_overlap))
+
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    # Чанк, собранный из соседних частей, - подстрока исходного текста
+    assert all(chunk in text for chunk in chunks)
+    # Слова w0, w1, ... уникальны: каждое попало в какой-то чанк, порядок чанков - порядок текста
+    positions = [int(chunk.replace('.', ' ').split()[0][1:]) for chunk in chunks]
+    assert positions == sorted(positions)
+    assert {w for chunk in chunks for w in _tokens(chunk)} == set(_tokens(text))
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_repeated_text_is_neither_dropped_nor_duplicated(seed):
+    # Из трех слов одинаковые фрагменты повторяются: чанки не должны
+    # ни терять, ни повторять текст при перекрытии 0
+    rnd = random.Random(seed)
+    text = _random_text(rnd, [rnd.choice(['alpha', 'beta', 'gamma'])
+                                for _ in range(rnd.randint(50, 3000))])
+    chunk_size = rnd.choice([50, 100, 300])
+
+    chunks = list(DocumentReader.split_stream(_random_pieces(rnd, text), chunk_size, 0))
+
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    assert [w for chunk in chunks for w in _tokens(chunk)] == _tokens(text)
+
+
+@pytest.mark.parametrize('seed', range(300))
+@pytest.mark.parametrize('parallel', [True, False])
+def test_matches_split_text(seed, parallel):
+    # Мелкие части, пробелы и пустые абзацы, chunk_size от 1 символа
+    rnd = random.Random(seed)
+    tokens = ['слово', 'a', 'x' * 30, '. ', '! ', '? ', '.', '\n', '\n\n', '\n\n\n', ' ', '  ']
+    text = ''.join(rnd.choices(tokens, [8, 5, 1, 2, 1, 1, 1, 2, 1, 1, 15, 1],
+                               k=rnd.randint(0, 400)))
+    chunk_size = rnd.choice([1, 2, 5, 10, 20, 50, 100])
+    chunk_overlap = rnd.choice([0, 1, chunk_size // 2]) if chunk_size > 1 else 0
+    pieces = _random_pieces(rnd, text) if len(text) > 20 else [text]
+
+    chunks = list(DocumentReader.split_stream(pieces, chunk_size, chunk_overlap,
+                                              parallel=parallel))
+
+    assert chunks == DocumentReader.split_text(text, chunk_size, chunk_overlap,
+                                               parallel=parallel)
+
+
+def _pages(rnd: random.Random, count: int) -> list:
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon']
+    pages = []
+    for _ in range(count):
+        paragraphs = []
+        for _ in range(rnd.randint(1, 6)):
+            sentences = [' '.join(rnd.choices(words, k=rnd.randint(3, 25))) +
+                         rnd.choice(['.', '!', '?', '']) for _ in range(rnd.randint(1, 8))]
+            paragraphs.append(rnd.choice([' ', '\n']).join(sentences))
+        pages.append(rnd.choice(['\n\n', '\n', '\n\n\n']).join(paragraphs) + '\n')
+    return pages
+
+
+@pytest.mark.parametrize('parallel', [True, False])
+@pytest.mark.parametrize('chunk_size,chunk_overlap', [(1000, 200), (500, 0), (200, 50)])
+def test_multipage_text_matches_split_text(parallel, chunk_size, chunk_overlap):
+    # 300 страниц - больше порога, после которого split_text делит по абзацам
+    pages = _pages(random.Random(chunk_size), 300)
+    text = ''.join(pages)
+    assert len(text) > readers.PARALLEL_SPLIT_CHARS
+
+    chunks = list(DocumentReader.split_stream(iter(pages), chunk_size, chunk_overlap,
+                                              parallel=parallel))
+    expected = DocumentReader.split_text(text, chunk_size, chunk_overlap, parallel=parallel)
+
+    assert len(chunks) == len(expected)
+    assert [len(chunk) for chunk in chunks] == [len(chunk) for chunk in expected]
+    assert chunks == expected
+
+
+def test_many_separator_lines_match_split_text():
+    # Строк больше порога: split_text делит их группами, границы групп не режут чанки
+    rnd = random.Random(0)
+    lines = ['---' if rnd.random() < 0.05 else ' '.join(rnd.choices(['a', 'b'], k=5))
+             for _ in range(3000)]
+    text = '\n'.join(lines)
+    pieces = [text[i:i + 777] for i in range(0, len(text), 777)]
+
+    chunks = list(DocumentReader.split_stream(pieces, None, None, custom_separators=['---']))
+
+    assert chunks == DocumentReader.split_text(text, custom_separators=['---'])
+    assert chunks == DocumentReader.split_text(text, custom_separators=['---'], parallel=False)
+
+
+def test_single_piece_matches_short_text():
+    text = "Первая фраза. Вторая фраза.\n\nТретья фраза."
+    assert list(DocumentReader.split_stream([text], 1000, 100)) == \
+        DocumentReader.split_text(text, 1000, 100)
+
+
+def test_separator_split_across_pieces():
+    text = "раздел один\nстрока\n---\nраздел два\n---\nраздел три"
+    pieces = ["раздел один\nстр", "ока\n-", "--\nраздел два\n--", "-\nраздел три"]
+
+    chunks = list(DocumentReader.split_stream(pieces, 1000, 0, custom_separators=['---']))
+
+    assert chunks == ["раздел один\nстрока", "раздел два", "раздел три"]
+    assert chunks == DocumentReader.split_text(text, 1000, 0, custom_separators=['---'])